@@ -1,4 +1,6 @@
 from utils_data import *
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.util import Finalize
 import time
 
 
@@ -17,43 +19,58 @@ def debug(s, end=None, flush=True):
         else:
             print(s)
 
-def update_record(code, update_kd, update_k5, i, item_num):
-    sur = StockUpdateRecord(code)
+session_manifest = None
+
+
+def session_init():
+    # every worker process is an independent baostock session with its own socket
+    global session_manifest
+    Stock.login()
+    Finalize(None, Stock.logout, exitpriority=10)
+    session_manifest = StockManifest()
+
+
+def update_record(code, update_kd, update_k5):
+    sur = StockUpdateRecord(code, session_manifest)
     if update_kd:
         sur.update_kd()
-        debug('\r({}/{}) {} Update kd finished    '.format(
-            i, item_num, code), end='', flush=True)
     if update_k5:
         sur.update_k5()
-        debug('\r({}/{}) {} Update k5 finished    '.format(
-            i, item_num, code), end='', flush=True)
+    return session_manifest.items.get(code, {})
 
 
 def update_data(stock_code, update_kd=True, update_k5=True):
     Stock.login()
-    sur = StockUpdateRecord(StockBasicInfo.code2bao(stock_code))
+    manifest = StockManifest()
+    sur = StockUpdateRecord(StockBasicInfo.code2bao(stock_code), manifest)
     if update_kd:
         sur.update_kd()
         print(stock_code, 'Update kd finished' + ' ' * 40)
     if update_k5:
         sur.update_k5()
         print(stock_code, 'Update k5 finished' + ' ' * 40)
+    manifest.save()
     Stock.logout()
 
 
-def update_all_data(update_kd=False, update_k5=False):
+def update_all_data(update_kd=False, update_k5=False, sessions=1):
     sbi = StocksBasicInfo()
     if not sbi.load_from_file('stock_update.list'):
         return
     item_list = sbi.get_list()
     item_num = len(item_list)
+    manifest = StockManifest()
+    if sessions > 1:
+        update_all_parallel([s.code for s in item_list if s.status is not StockStatus.DELISTING],
+                            update_kd, update_k5, sessions, manifest)
+        return
     Stock.login()
     if True:
         for i in range(item_num):
             assert(isinstance(item_list[i], StockBasicInfo))
             if item_list[i].status is StockStatus.DELISTING:
                 continue
-            sur = StockUpdateRecord(item_list[i].code)
+            sur = StockUpdateRecord(item_list[i].code, manifest)
             if update_kd:
                 sur.update_kd()
                 debug('\r({}/{}) {} Update kd finished    '.format(
@@ -62,17 +79,43 @@ def update_all_data(update_kd=False, update_k5=False):
                 sur.update_k5()
                 debug('\r({}/{}) {} Update k5 finished    '.format(
                     i, item_num, item_list[i].code), end='', flush=True)
-    else:
-        with concurrent.futures.ThreadPoolExecutor(1) as executor:
-            for i in range(item_num):
-                assert(isinstance(item_list[i], StockBasicInfo))
-                if item_list[i].status is StockStatus.DELISTING:
-                    continue
-                executor.submit(update_record, item_list[i].code, update_kd, update_k5, i, item_num)
+            if i % 100 == 99:
+                manifest.save()
+    manifest.save()
+    if update_kd:
+        StocksSnapshot().build([s.code for s in item_list if s.status is not StockStatus.DELISTING], manifest)
     print('\rUpdate finished.' + ' ' * 40)
     Stock.logout()
 
 
+def update_all_parallel(code_list, update_kd, update_k5, sessions, manifest):
+    item_num = len(code_list)
+    retried = {}
+    finished = 0
+    with ProcessPoolExecutor(sessions, initializer=session_init) as executor:
+        running = {executor.submit(update_record, code, update_kd, update_k5): code for code in code_list}
+        while len(running) > 0:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                code = running.pop(future)
+                try:
+                    manifest.items[code] = future.result()
+                except Exception as e:
+                    retried[code] = retried.get(code, 0) + 1
+                    if retried[code] <= Stock.RETRY_MAX_NUM:
+                        running[executor.submit(update_record, code, update_kd, update_k5)] = code
+                        continue
+                    print('\r{} Update failed: {}'.format(code, e))
+                finished += 1
+                debug('\r({}/{}) {} Update finished    '.format(finished, item_num, code), end='', flush=True)
+                if finished % 100 == 0:
+                    manifest.save()
+    manifest.save()
+    if update_kd:
+        StocksSnapshot().build(code_list, manifest)
+    print('\rUpdate finished.' + ' ' * 40)
+
+
 if __name__ == '__main__':
     s = time.time()
     update_all_data(True, True)
@@ -1,14 +1,19 @@
 from utils_data import *
 from utils_config import UtilsConfig
 from utils_baostock import Stock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import datetime
 
 
 __all__ = [
     'update_all_info',
     'update_recent_nmc',
-    'update_report'
+    'update_report',
+    'load_report'
 ]
 
+REPORT_FIRST_YEAR = 2010
+
 
 def update_all_info():
     sbi = StocksBasicInfo()
@@ -65,26 +70,57 @@ def update_recent_nmc(file_name='v_nmc.db'):
     EnvParam(path).put(nmc).save()
 
 
-def update_report(file_name='v_report.db'):
+def report_key(year, quarter):
+    return '{}Q{}'.format(year, quarter)
+
+
+def report_quarters():
+    # (year, quarter) from REPORT_FIRST_YEAR up to the current quarter
+    today = datetime.date.today()
+    return [(y, q) for y in range(REPORT_FIRST_YEAR, today.year + 1) for q in range(1, 5)
+            if (y, q) <= (today.year, (today.month - 1) // 3 + 1)]
+
+
+def update_report(file_name='v_report.db', workers=4):
+    # one EnvParam param per quarter, saved as soon as it is downloaded. quarters already stored are
+    # skipped except the latest one, which still changes while its reports are being published
     path = UtilsConfig.get_stock_list_path(file_name)
     if path is None:
         return
     env = EnvParam(path)
     report = env.get()
-    report = {} if report is None else report
-    last_rec = None
-    for y in range(2010, 2099):
-        for q in range(1, 5):
-            if (y, q) not in report:
-                req = StockRtData.get_report_data(y, q)
-                if req is None or len(req) == 0:
-                    if last_rec is not None:
-                        req = StockRtData.get_report_data(*last_rec)
-                        report[last_rec] = req
-                    env.put(report).save()
-                    return
-                report[(y, q)] = req
-                last_rec = (y, q)
+    if report is not None:  # all quarters in one param, written by the former update_report
+        for (y, q), req in report.items():
+            env.put(req, report_key(y, q))
+        env.delete().save()
+    keys = env.keys()
+    stored = [(y, q) for y, q in report_quarters() if report_key(y, q) in keys]
+    todo = [yq for yq in report_quarters() if yq not in stored] + stored[-1:]
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(StockRtData.get_report_data, y, q): (y, q) for y, q in todo}
+        for future in as_completed(futures):
+            y, q = futures[future]
+            try:
+                req = future.result()
+            except Exception as e:
+                print('Update report {} failed: {}'.format(report_key(y, q), e))
+                continue
+            if req is not None and len(req) > 0:
+                env.put(req, report_key(y, q)).save()
+                print('Update report {}: {} items'.format(report_key(y, q), len(req)))
+
+
+def load_report(file_name='v_report.db'):
+    # {(year, quarter): {code: DataReport}} as update_report used to store it
+    path = UtilsConfig.get_stock_list_path(file_name)
+    if path is None:
+        return {}
+    env = EnvParam(path)
+    report = env.get()
+    if report is not None:
+        return report
+    keys = env.keys()
+    return {(y, q): env.get(report_key(y, q)) for y, q in report_quarters() if report_key(y, q) in keys}
 
 
 def update_up_list(file_name='stock_update.list', nmc_name='v_nmc.db'):
@@ -74,6 +74,17 @@ class Stock:
         fields = 'time, open, close, high, low, volume, amount'
         return Stock.query_history_k_data(code, fields, start_date, end_date, frequency='5')
 
+    @staticmethod
+    def query_adjust_factor(code, start_date=None, end_date=None):
+        rs = bs.query_adjust_factor(code, start_date, end_date)
+        while Stock.retried_num < Stock.RETRY_MAX_NUM and rs.error_code != '0':
+            sleep(Stock.RETRY_DELAY_S)
+            rs = bs.query_adjust_factor(code, start_date, end_date)
+            Stock.retried_num += 1
+        if '0' == rs.error_code:
+            Stock.retried_num = 0
+            return Stock.rs_to_list(rs)
+
     @staticmethod
     def query_stock_industry(code='', date=''):
         rs = bs.query_stock_industry(code, date)
@@ -10,12 +10,21 @@ import csv
 from collections import OrderedDict
 from utils_config import UtilsConfig
 from enum import IntEnum
-from struct import pack, unpack
+from struct import pack, unpack, error as StructError
 from copy import deepcopy
-from threading import Thread
+from threading import Thread, Lock, Condition, Event
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pinyin import *
 from time import sleep, strftime
 import pickle
+import zlib
+import ast
+import sqlite3
+import codecs
+from html.parser import HTMLParser
+from contextlib import closing
+import numpy as np
 # from utils_tushare import *
 from utils_baostock import *
 
@@ -34,17 +43,36 @@ __all__ = [
     'StockIndustryInfo',
     'StocksIndustryInfo',
     'StockData',
+    'RecordView',
     'StockRtData',
+    'StockRtRecorder',
+    'StockRtBus',
+    'StockRtSubscriber',
     'DataKzz',
     'DataKzzD',
     'StockUpdateRecord',
+    'DataIndex',
+    'StockDataIndex',
+    'StockArchive',
+    'StockManifest',
+    'StockBars',
+    'DataAdjust',
+    'StockAdjust',
+    'StockIntegrity',
+    'StocksPanel',
+    'StocksSnapshot',
+    'StocksScreener',
     'get_weekday',
+    'hex_fmt_dtype',
     'html_get_tables',
+    'HtmlTables',
     'Stock',
     'EnvParam',
     'Date',
     'get_hist_data',
     'CHistCache',
+    'HistCache',
+    'HistEntry',
 ]
 
 
@@ -57,31 +85,78 @@ def get_weekday(date):
     return date.weekday(), week_str[date.weekday()]
 
 
+def hex_fmt_dtype(fmt, names):
+    # struct format -> numpy structured dtype, e.g. ('<LfL', ['date', 'open', ...])
+    np_type = {'L': 'u4', 'Q': 'u8', 'f': 'f4'}
+    assert(fmt[0] == '<' and len(fmt) - 1 == len(names))
+    return np.dtype([(name, fmt[0] + np_type[c]) for name, c in zip(names, fmt[1:])])
+
+
+class HtmlTables(HTMLParser):
+    # single pass <table>/<tr>/<td> extractor, html can be fed in chunks as it is received.
+    # tables: list of tables with at least one row, a row is the list of its <td> texts, or
+    # row_builder(cells) if given (rows it returns None for are dropped)
+    def __init__(self, row_builder=None):
+        super().__init__(convert_charrefs=True)
+        self.row_builder = row_builder
+        self.tables = []
+        self.stack = []  # (rows, row, cell) of the enclosing tables, the innermost open table is in table/row/cell
+        self.table = None
+        self.row = None
+        self.cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            if self.table is not None:
+                self.stack.append((self.table, self.row, self.cell))
+            self.table, self.row, self.cell = [], None, None
+        elif tag == 'tr' and self.table is not None:
+            self.handle_endtag('tr')
+            self.row = []
+        elif tag == 'td' and self.row is not None:
+            self.handle_endtag('td')
+            self.cell = []
+
+    def handle_endtag(self, tag):
+        if tag == 'td' and self.cell is not None:
+            self.row.append(''.join(self.cell))
+            self.cell = None
+        elif tag == 'tr' and self.row is not None:
+            self.handle_endtag('td')
+            row = self.row if self.row_builder is None else self.row_builder(self.row)
+            if row is not None:
+                self.table.append(row)
+            self.row = None
+        elif tag == 'table' and self.table is not None:
+            self.handle_endtag('tr')
+            if len(self.table) > 0:
+                self.tables.append(self.table)
+            self.table, self.row, self.cell = self.stack.pop() if len(self.stack) > 0 else (None, None, None)
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+    @staticmethod
+    def from_response(r, encoding, row_builder=None, chunk_size=64*1024):
+        # parses a requests response opened with stream=True, returns (parser, decoded length)
+        parser = HtmlTables(row_builder)
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        length = 0
+        for chunk in r.iter_content(chunk_size):
+            text = decoder.decode(chunk)
+            length += len(text)
+            parser.feed(text)
+        parser.feed(decoder.decode(b'', final=True))
+        parser.close()
+        return parser, length
+
+
 def html_get_tables(html_text):
-    tables = []
-    tbs = re.compile(r'<table.*?>.*?</table>', re.DOTALL).findall(html_text)
-    for tb in tbs:
-        trs = re.compile(r'<tr.*?>.*?</tr>', re.DOTALL).findall(tb)
-        table = []
-        for tr in trs:
-            tds = re.compile(r'<td.*?>.*?</td>', re.DOTALL).findall(tr)
-            in_mark = False
-            line = []
-            for td in tds:
-                td_str = ''
-                for c in td:
-                    if c == '<':
-                        in_mark = True
-                    elif c == '>':
-                        in_mark = False
-                    else:
-                        if not in_mark:
-                            td_str += c
-                line.append(td_str)
-            table.append(line)
-        if len(table) > 0:
-            tables.append(table)
-    return tables
+    parser = HtmlTables()
+    parser.feed(html_text)
+    parser.close()
+    return parser.tables
 
 
 class StockType(IntEnum):
@@ -358,44 +433,165 @@ class StocksIndustryInfo:
             print(value)
 
 
+class RecordView:
+    # lazy list over a numpy (memmap) array, rows are built by `builder` only when accessed.
+    # index may also be a function of the array, it is evaluated on first access
+    def __init__(self, array, builder, index=None):
+        self.array = array
+        self.builder = builder
+        self._index = index
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = np.arange(len(self.array))
+        elif callable(self._index):
+            self._index = self._index(self.array)
+        return self._index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return RecordView(self.array, self.builder, self.index[item])
+        return self.builder(self.array[self.index[item]])
+
+    def __iter__(self):
+        for i in self.index:
+            yield self.builder(self.array[i])
+
+    def to_numpy(self):
+        return self.array[self.index]
+
+
 class StockData:
     NEW_FILE_DATE = '150101'
+    MODE_OBJ = 0  # kd_list/k5_list hold DataD/Data5 objects
+    MODE_NP = 1   # kd_list/k5_list hold numpy structured arrays (DataD.DTYPE/Data5.DTYPE)
+    MODE_MMAP = 2  # kd_list/k5_list are RecordView over memory-mapped files
 
-    def __init__(self, code, load_kd=0, load_k5=0, sync=False, start_date=0, end_date=999999):
+    def __init__(self, code, load_kd=0, load_k5=0, sync=False, start_date=0, end_date=999999, mode=MODE_OBJ,
+                 fqt=0):
+        # fqt: 0,1,2: no,front,back adjusted prices (StockAdjust), not available in MODE_MMAP
         assert(isinstance(code, str))
-        assert(not sync)
+        assert(fqt == 0 or mode != StockData.MODE_MMAP)
         self.code = code
+        self.mode = mode
         self.kd_list = []
         self.k5_list = []
         self.sync = sync
         self.sync_len = 0
+        self.sync_kd_idx = np.zeros(0, dtype=np.int64)
+        self.sync_k5_idx = np.zeros(0, dtype=np.int64)
         load_kd = load_k5 = max(load_k5, load_kd)
-        close_set = set()
+        if mode in (StockData.MODE_NP, StockData.MODE_MMAP):
+            self._load_np(load_kd, load_k5, start_date, end_date)
+        else:
+            close_set = set()
+            if load_kd > 0:
+                self.load_kd(load_kd, start_date, end_date)
+                close_set = set(kd.date_num for kd in self.kd_list if kd.trade_status != StockTradeStatus.ON)
+                self.kd_list = [kd for kd in self.kd_list if kd.trade_status == StockTradeStatus.ON]
+            if load_k5 > 0:
+                self.load_k5(load_k5, start_date, end_date)
+                self.k5_list = [k5 for k5 in self.k5_list if k5[0].date_num not in close_set and k5[0].open >= 0.1]
+        if fqt != 0:
+            self.adjust(fqt)
+        if sync:
+            self.sync_dates()
+
+    def adjust(self, fqt):
+        adj = StockAdjust(self.code)
+        if self.mode == StockData.MODE_NP:
+            self.kd_list = adj.adjust_np(self.kd_list, fqt) if len(self.kd_list) > 0 else self.kd_list
+            self.k5_list = adj.adjust_np(self.k5_list, fqt) if len(self.k5_list) > 0 else self.k5_list
+        else:
+            adj.adjust_list(self.kd_list, fqt)
+            adj.adjust_list(self.k5_list, fqt)
+
+    def date_keys(self):
+        # date_num of every kd_list item and every k5_list day
+        if self.mode == StockData.MODE_NP:
+            return self.kd_list['date'], self.k5_list[:, 0]['time'] // 10000
+        elif self.mode == StockData.MODE_MMAP:
+            return self.kd_list.array['date'][self.kd_list.index], \
+                   self.k5_list.array[:, 0]['time'][self.k5_list.index] // 10000
+        return np.array([kd.date_num for kd in self.kd_list], dtype=np.uint32), \
+            np.array([k5[0].date_num for k5 in self.k5_list], dtype=np.uint32)
+
+    def sync_dates(self):
+        # sort-merge kd and k5 on date: sync_kd_idx/sync_k5_idx index the days present in both lists,
+        # sync_len is the length of the aligned tails kd_list[-sync_len:] / k5_list[-sync_len:]
+        kd_dates, k5_dates = self.date_keys()
+        if len(kd_dates) > 1 and len(k5_dates) > 0 and \
+                kd_dates[-1] != k5_dates[-1] and kd_dates[-2] == k5_dates[-1]:  # k5 not updated for the last day
+            self.kd_list = self.kd_list[:-1]
+            kd_dates = kd_dates[:-1]
+        _, self.sync_kd_idx, self.sync_k5_idx = np.intersect1d(kd_dates, k5_dates, return_indices=True)
+        n = len(self.sync_kd_idx)
+        aligned = (self.sync_kd_idx == np.arange(len(kd_dates) - n, len(kd_dates))) & \
+                  (self.sync_k5_idx == np.arange(len(k5_dates) - n, len(k5_dates)))
+        self.sync_len = n - (np.flatnonzero(~aligned)[-1] + 1 if not aligned.all() else 0)
+
+    def _load_np(self, load_kd, load_k5, start_date, end_date):
+        if self.mode == StockData.MODE_MMAP:
+            return self._load_mmap(load_kd, load_k5, start_date, end_date)
+        close_dates = np.zeros(0, dtype=np.uint32)
         if load_kd > 0:
+            self.kd_list = np.zeros(0, dtype=DataD.DTYPE)
             self.load_kd(load_kd, start_date, end_date)
-            for i in range(len(self.kd_list) - 1, -1, -1):
-                if self.kd_list[i].trade_status != StockTradeStatus.ON:
-                    close_set.add(self.kd_list[i].date_num)
-                    del(self.kd_list[i])
+            off = self.kd_list['trade_status'] != StockTradeStatus.ON
+            close_dates = self.kd_list['date'][off]
+            self.kd_list = self.kd_list[~off]
         if load_k5 > 0:
+            self.k5_list = np.zeros((0, 48), dtype=Data5.DTYPE)
             self.load_k5(load_k5, start_date, end_date)
-            for i in range(len(self.k5_list) - 1, -1, -1):
-                if self.k5_list[i][0].date_num in close_set or self.k5_list[i][0].open < 0.1:
-                    del(self.k5_list[i])
-        if sync:
-            if len(self.kd_list) <= 1 or len(self.k5_list) == 0 or \
-                    (self.kd_list[-1].date_num != self.k5_list[-1][0].date_num and
-                     self.kd_list[-2].date_num != self.k5_list[-1][0].date_num):
-                self.sync_len = 0
-            else:
-                if self.kd_list[-1].date_num != self.k5_list[-1][0].date_num:
-                    del(self.kd_list[-1])
-                max_len = min(len(self.kd_list), len(self.k5_list))
-                for i in range(-1, -max_len-1, -1):
-                    if self.kd_list[i].date_num == self.k5_list[i][0].date_num:
-                        self.sync_len += 1
-                    else:
-                        break
+            first = self.k5_list[:, 0]
+            keep = ~np.isin(first['time'] // 10000, close_dates) & (first['open'] >= 0.1)
+            self.k5_list = self.k5_list[keep]
+
+    def _load_mmap(self, load_kd, load_k5, start_date, end_date):
+        # only maps the files, the trade_status/open filters read the records on first access of the views
+        kd = np.zeros(0, dtype=DataD.DTYPE)
+        if load_kd > 0:
+            self.kd_list = kd
+            self.load_kd(load_kd, start_date, end_date)
+            kd = self.kd_list
+            self.kd_list = RecordView(kd, DataD.from_np,
+                                      lambda a: np.flatnonzero(a['trade_status'] == StockTradeStatus.ON))
+        if load_k5 > 0:
+            self.k5_list = np.zeros((0, 48), dtype=Data5.DTYPE)
+            self.load_k5(load_k5, start_date, end_date)
+
+            def keep(a):
+                close_dates = kd['date'][kd['trade_status'] != StockTradeStatus.ON]
+                first = a[:, 0]
+                return np.flatnonzero(~np.isin(first['time'] // 10000, close_dates) & (first['open'] >= 0.1))
+            self.k5_list = RecordView(self.k5_list, Data5.from_np_day, keep)
+
+    @staticmethod
+    def seek_hex(f, size, rec_len, days_len, start_date=0, end_date=999999, date_div=1):
+        # records are appended in date order: bisect on the leading '<L' date field only,
+        # returns the [first, last) record index of the last `days_len` records within the dates
+        def bisect_date(lo, hi, date, right):
+            while lo < hi:
+                mid = (lo + hi) // 2
+                f.seek(mid * rec_len)
+                d = unpack('<L', f.read(4))[0] // date_div
+                if d < date or (right and d == date):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+        rec_num = size // rec_len
+        first = max(0, rec_num - days_len)
+        last = rec_num
+        if start_date > 0:
+            first = bisect_date(first, last, start_date, False)
+        if end_date < 999999:
+            last = bisect_date(first, last, end_date, True)
+        return first, last
 
     @staticmethod
     def parse_hex_k5(path, days, start_date=0, end_date=999999):
@@ -404,19 +600,12 @@ class StockData:
         size = os.path.getsize(path)
         if 0 == (size % Data5.HEX_LEN):
             f = open(path, 'rb')
-            if days < size//Data5.HEX_LEN//48:
-                f.seek(-days * Data5.HEX_LEN * 48, 2)  # from the end of file
-            else:
-                days = size//Data5.HEX_LEN//48
-            all_data = f.read(days * 48 * Data5.HEX_LEN)
-            for i in range(days * 48):
+            first, last = StockData.seek_hex(f, size, Data5.HEX_LEN, days * 48, start_date, end_date, 10000)
+            f.seek(first * Data5.HEX_LEN)
+            all_data = f.read((last - first) * Data5.HEX_LEN)
+            for i in range(last - first):
                 item_data = all_data[i * Data5.HEX_LEN:(i+1) * Data5.HEX_LEN]
-                data = Data5(*unpack(Data5.FMT_HEX, item_data))
-                if start_date <= data.date_num:
-                    if data.date_num <= end_date:
-                        data_list.append(data)
-                    else:
-                        break
+                data_list.append(Data5(*unpack(Data5.FMT_HEX, item_data)))
             f.close()
             if (len(data_list) % 48) != 0:  # lose part data of a day
                 print('Data seems wrong: {}  {}'.format(path, len(data_list)))
@@ -432,29 +621,126 @@ class StockData:
         size = os.path.getsize(path)
         if 0 == (size % DataD.HEX_LEN):
             f = open(path, 'rb')
-            if days < size//DataD.HEX_LEN:
-                f.seek(-days * DataD.HEX_LEN, 2)  # from the end of file
-            else:
-                days = size//DataD.HEX_LEN
-            all_data = f.read(days * DataD.HEX_LEN)
-            for i in range(days):
+            first, last = StockData.seek_hex(f, size, DataD.HEX_LEN, days, start_date, end_date)
+            f.seek(first * DataD.HEX_LEN)
+            all_data = f.read((last - first) * DataD.HEX_LEN)
+            for i in range(last - first):
                 item_data = all_data[i * DataD.HEX_LEN:(i+1)*DataD.HEX_LEN]
                 params = unpack(DataD.FMT_HEX, item_data)
-                data = DataD(*(params[:5]+params[6:]))  # ignore unused integer
-                if start_date <= data.date_num:
-                    if data.date_num <= end_date:
-                        ret_list.append(data)
-                    else:
-                        break
+                ret_list.append(DataD(*(params[:5]+params[6:])))  # ignore unused integer
             f.close()
             return ret_list
         else:
             print('File size error: ' + path)
 
+    @staticmethod
+    def parse_np_k5(path, days, start_date=0, end_date=999999):
+        # same as parse_hex_k5, returns a (days, 48) array of Data5.DTYPE
+        size = os.path.getsize(path)
+        if 0 == (size % Data5.HEX_LEN):
+            with open(path, 'rb') as f:
+                first, last = StockData.seek_hex(f, size, Data5.HEX_LEN, days * 48, start_date, end_date, 10000)
+                f.seek(first * Data5.HEX_LEN)
+                data = np.fromfile(f, dtype=Data5.DTYPE, count=last - first)
+            if (len(data) % 48) != 0:  # lose part data of a day
+                print('Data seems wrong: {}  {}'.format(path, len(data)))
+            return data[:len(data) // 48 * 48].reshape(-1, 48)
+        else:
+            print('File size error: ' + path)
+
+    @staticmethod
+    def parse_np_kd(path, days, start_date=0, end_date=999999):
+        # same as parse_hex_kd, returns an array of DataD.DTYPE
+        size = os.path.getsize(path)
+        if 0 == (size % DataD.HEX_LEN):
+            with open(path, 'rb') as f:
+                first, last = StockData.seek_hex(f, size, DataD.HEX_LEN, days, start_date, end_date)
+                f.seek(first * DataD.HEX_LEN)
+                return np.fromfile(f, dtype=DataD.DTYPE, count=last - first)
+        else:
+            print('File size error: ' + path)
+
+    @staticmethod
+    def select_index(index, days, start_date=0, end_date=999999):
+        index = index[max(0, len(index) - days):]
+        return index[(start_date <= index['date']) & (index['date'] <= end_date)]
+
+    @staticmethod
+    def parse_idx_k5(path, index, days, start_date=0, end_date=999999):
+        # days located by the sidecar index, a partial day is kept with its real bar count
+        index = StockData.select_index(index, days, start_date, end_date)
+        if len(index) == 0:
+            return []
+        first = int(index['offset'][0])
+        with open(path, 'rb') as f:
+            f.seek(first)
+            all_data = f.read(int(index['offset'][-1]) + int(index['count'][-1]) * Data5.HEX_LEN - first)
+        ret_list = []
+        for offset, count in zip(index['offset'] - first, index['count']):
+            ret_list.append([Data5(*unpack(Data5.FMT_HEX, all_data[i:i + Data5.HEX_LEN]))
+                             for i in range(offset, offset + count * Data5.HEX_LEN, Data5.HEX_LEN)])
+        return ret_list
+
+    @staticmethod
+    def parse_idx_np_k5(path, index, days, start_date=0, end_date=999999):
+        # (days, 48) array located by the sidecar index, partial days are skipped
+        index = StockData.select_index(index, days, start_date, end_date)
+        index = index[index['count'] == 48]
+        if len(index) == 0:
+            return np.zeros((0, 48), dtype=Data5.DTYPE)
+        first = int(index['offset'][0])
+        with open(path, 'rb') as f:
+            f.seek(first)
+            data = np.fromfile(f, dtype=Data5.DTYPE, count=(int(index['offset'][-1]) - first) // Data5.HEX_LEN + 48)
+        return data[((index['offset'] - first) // Data5.HEX_LEN)[:, None] + np.arange(48)]
+
+    @staticmethod
+    def mmap_hex(path, dtype, rec_num, days, start_date=0, end_date=999999, date_div=1):
+        # map the last `days` records read-only, then narrow to [start_date, end_date] without copying
+        size = os.path.getsize(path)
+        if 0 != (size % dtype.itemsize):
+            print('File size error: ' + path)
+            return None
+        days = min(days, size // dtype.itemsize // rec_num)
+        if days == 0:
+            return np.zeros((0, rec_num), dtype=dtype)
+        offset = size - days * rec_num * dtype.itemsize
+        data = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(days, rec_num))
+        if start_date <= 0 and end_date >= 999999:
+            return data
+
+        def bisect_date(date, right):
+            # touches only the pages of the probed rows
+            lo, hi = 0, len(data)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                d = int(data[mid, 0][dtype.names[0]]) // date_div
+                if d < date or (right and d == date):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+        return data[bisect_date(start_date, False):bisect_date(end_date, True)]
+
+    @staticmethod
+    def parse_mmap_k5(path, days, start_date=0, end_date=999999):
+        # same as parse_np_k5 but backed by the OS page cache, assumes 48 bars per day
+        return StockData.mmap_hex(path, Data5.DTYPE, 48, days, start_date, end_date, date_div=10000)
+
+    @staticmethod
+    def parse_mmap_kd(path, days, start_date=0, end_date=999999):
+        data = StockData.mmap_hex(path, DataD.DTYPE, 1, days, start_date, end_date)
+        return None if data is None else data[:, 0]
+
     def load_kd(self, days, start_date=0, end_date=999999):
         path = UtilsConfig.get_stock_data_path(self.code, stock_type='kd')
         if path is not None and os.path.isfile(path):
-            self.kd_list = StockData.parse_hex_kd(path, days, start_date, end_date)
+            if self.mode == StockData.MODE_NP:
+                self.kd_list = StockData.parse_np_kd(path, days, start_date, end_date)
+            elif self.mode == StockData.MODE_MMAP:
+                self.kd_list = StockData.parse_mmap_kd(path, days, start_date, end_date)
+            else:
+                self.kd_list = StockData.parse_hex_kd(path, days, start_date, end_date)
             return True
         else:
             # print(self.code, 'Load kd error')
@@ -462,27 +748,62 @@ class StockData:
 
     def load_k5(self, days, start_date=0, end_date=999999):
         path = UtilsConfig.get_stock_data_path(self.code, stock_type='k5')
+        loaded = False
         if path is not None and os.path.isfile(path):
-            self.k5_list = StockData.parse_hex_k5(path, days, start_date, end_date)
-            return True
+            index = StockDataIndex(self.code, 'k5').load() if self.mode != StockData.MODE_MMAP else None
+            if self.mode == StockData.MODE_NP:
+                if index is not None:
+                    self.k5_list = StockData.parse_idx_np_k5(path, index, days, start_date, end_date)
+                else:
+                    self.k5_list = StockData.parse_np_k5(path, days, start_date, end_date)
+            elif self.mode == StockData.MODE_MMAP:
+                self.k5_list = StockData.parse_mmap_k5(path, days, start_date, end_date)
+            elif index is not None:
+                self.k5_list = StockData.parse_idx_k5(path, index, days, start_date, end_date)
+            else:
+                self.k5_list = StockData.parse_hex_k5(path, days, start_date, end_date)
+            hot_days = len(index) if index is not None else os.path.getsize(path) // Data5.HEX_LEN // 48
+            loaded = True
         else:
-            # print(self.code, 'Load k5 error')
+            hot_days = 0
+        # years are only archived from the head of an existing hot file
+        if loaded and self.mode != StockData.MODE_MMAP and self.k5_list is not None and hot_days < days:
+            hot_first_date = StockArchive(self.code).hot_first_date()
+            if start_date < hot_first_date:
+                self.load_k5_archive(days - hot_days, start_date, end_date, hot_first_date)
+        # if not loaded: print(self.code, 'Load k5 error')
+        return loaded
+
+    def load_k5_archive(self, days, start_date=0, end_date=999999, hot_first_date=None):
+        # prepend the archived days when the `days` window reaches past the head of the hot k5 file
+        archive = StockArchive(self.code)
+        hot_first_date = archive.hot_first_date() if hot_first_date is None else hot_first_date
+        k5_list = archive.load_k5(start_date, end_date, self.mode == StockData.MODE_NP, days, hot_first_date)
+        if len(k5_list) == 0:
             return False
+        if self.mode == StockData.MODE_NP:
+            self.k5_list = np.concatenate([k5_list, self.k5_list]) if len(self.k5_list) > 0 else k5_list
+        else:
+            self.k5_list = k5_list + list(self.k5_list)
+        return True
 
     @staticmethod
-    def check_update_failed(filename='stock_update.list'):
+    def check_update_failed(filename='stock_update.list', manifest_name='data_manifest.db'):
         sbi = StocksBasicInfo()
         sbi.load_from_file(filename)
+        manifest = StockManifest(manifest_name)
         update_list = []
         for s in sbi.get_list():
             assert(isinstance(s, StockBasicInfo))
-            sd = StockData(s.code, 1, 1)
-            update_list.append((
-                sd.code,
-                sd.kd_list[-1].date_num if len(sd.kd_list) > 0 else 0,
-                999999 if s.type == StockType.INDEX else sd.k5_list[-1][-1].date_num if len(sd.k5_list) > 0 else 0,
-                s.code_name, s.type
-            ))
+            # entries are only used while the file size matches, writers without a manifest make them stale
+            kd, k5 = manifest.get(s.code, 'kd'), manifest.get(s.code, 'k5')
+            if kd is not None and (k5 is not None or s.type == StockType.INDEX):
+                kd_date, k5_date = kd[0], (999999 if s.type == StockType.INDEX else k5[0] // 10000)
+            else:
+                sd = StockData(s.code, 1, 1)
+                kd_date = sd.kd_list[-1].date_num if len(sd.kd_list) > 0 else 0
+                k5_date = 999999 if s.type == StockType.INDEX else sd.k5_list[-1][-1].date_num if len(sd.k5_list) > 0 else 0
+            update_list.append((s.code, kd_date, k5_date, s.code_name, s.type))
         if len(update_list) > 0:
             thrust_date_str = str(datetime.datetime.today().date() + datetime.timedelta(-90))
             thrust_date = int(thrust_date_str[2:4]+thrust_date_str[5:7]+thrust_date_str[8:10])
@@ -511,9 +832,21 @@ class StockData:
             sbi.save_to_file('stock_new.list')
 
 
-class Data5:
+class SlotsRecord:
+    # base of the compact record types, their attributes live in __slots__ instead of a per-instance __dict__
+    __slots__ = ()
+
+    def __setstate__(self, state):
+        # state is (None, slots) for slotted pickles and a plain dict for pickles written before __slots__
+        for k, v in (state[1] if isinstance(state, tuple) else state).items():
+            setattr(self, k, v)
+
+
+class Data5(SlotsRecord):
+    __slots__ = ('time_str', 'date_num', 'open', 'close', 'high', 'low', 'volume', 'amount')
     FMT_HEX = '<LffffLf'
     HEX_LEN = 4*7
+    DTYPE = hex_fmt_dtype(FMT_HEX, ['time', 'open', 'close', 'high', 'low', 'volume', 'amount'])
 
     def __init__(self, v_time, v_open, v_close, v_high, v_low, volume, amount):
         # ['20181109150000000', '18.5400', '18.5200', '18.5500', '18.5000', '99200', '1837097.0000']
@@ -529,15 +862,41 @@ class Data5:
         self.volume = int(volume)
         self.amount = float(amount)
 
+    @staticmethod
+    def from_np(row):
+        return Data5(*row.item())
+
+    @staticmethod
+    def from_np_day(rows):
+        return [Data5(*row.item()) for row in rows]
+
+    @staticmethod
+    def from_rows(rows):
+        # baostock k5 rows -> Data5.DTYPE array sorted by time, same values as Data5(*row)
+        data = np.zeros(len(rows), dtype=Data5.DTYPE)
+        if len(rows) == 0:
+            return data
+        cols = np.array(rows, dtype=str).T
+        time_num = cols[0].astype(np.int64)
+        data['time'] = time_num // 100000 % 10000000000  # '20181109150000000' -> 1811091500
+        for i, name in enumerate(['open', 'close', 'high', 'low', 'volume', 'amount']):
+            data[name] = cols[i + 1].astype(np.float64 if name != 'volume' else np.int64)
+        return data[np.argsort(time_num, kind='stable')]
+
     def __str__(self):
         return '{}  {:6.2f}  {:6.2f}  {:6.2f}  {:6.2f}  {:10d}  {:.0f}'. \
             format(self.time_str, self.open, self.close,
                    self.high, self.low, self.volume, self.amount)
 
 
-class DataD:
+class DataD(SlotsRecord):
+    __slots__ = ('date_str', 'date_num', 'open', 'close', 'high', 'low', 'volume', 'amount', 'adjust_flag',
+                 'turn', 'trade_status', 'pctChg', 'peTTM', 'psTTM', 'pcfNcfTTM', 'pbMRQ', 'isST')
     FMT_HEX = '<LffffLQfLfLfffffL'
     HEX_LEN = 4*18
+    DTYPE = hex_fmt_dtype(FMT_HEX, ['date', 'open', 'close', 'high', 'low', 'unused', 'volume', 'amount',
+                                    'adjust_flag', 'turn', 'trade_status', 'pctChg', 'peTTM',
+                                    'psTTM', 'pcfNcfTTM', 'pbMRQ', 'isST'])
 
     def __init__(self, date, v_open, v_close, v_high, v_low, volume, amount, adjust_flag,
                  turn, trade_status, pctChg, peTTM, psTTM, pcfNcfTTM, pbMRQ, isST):
@@ -571,15 +930,58 @@ class DataD:
             self.pctChg, self.peTTM, self.psTTM, self.pcfNcfTTM = 0.0, 0.0, 0.0, 0.0
             self.pbMRQ, self.isST = 0.0, False
 
+    @staticmethod
+    def from_np(row):
+        params = row.item()
+        return DataD(*(params[:5]+params[6:]))  # ignore unused integer
+
+    @staticmethod
+    def from_rows(rows):
+        # baostock kd rows -> DataD.DTYPE array, same values as DataD(*row) including its error fallback
+        data = np.zeros(len(rows), dtype=DataD.DTYPE)
+        if len(rows) == 0:
+            return data
+        cols = np.array(rows, dtype=str).T
+        data['date'] = np.char.replace(cols[0], '-', '').astype(np.uint32) % 1000000
+        data['isST'] = cols[15] != ''  # bool(isST)
+        error = np.zeros(len(rows), dtype=bool)
+        for i in [1, 2, 3, 4, 5, 6, 7, 9, 11, 12, 13, 14]:  # fields without an empty default
+            error |= cols[i] == ''
+        cols = np.where(cols == '', '0', cols)
+        names = [name for name in DataD.DTYPE.names if name not in ('date', 'unused', 'isST')]
+        try:
+            for i, name in enumerate(names):
+                data[name] = cols[i + 1].astype(np.int64 if DataD.DTYPE[name].kind == 'u' else np.float64)
+        except ValueError:  # malformed number, convert row by row
+            return np.array([DataD(*row).to_np() for row in rows], dtype=DataD.DTYPE)
+        error |= ~np.isin(data['trade_status'], [int(StockTradeStatus.ON), int(StockTradeStatus.OFF)])
+        date = data['date'].copy()
+        data[error] = np.zeros(1, dtype=DataD.DTYPE)
+        data['date'] = date
+        data['trade_status'][error] = StockTradeStatus.DATA_ERROR
+        return data
+
+    def to_np(self):
+        return (self.date_num, self.open, self.close, self.high, self.low, 0, self.volume, self.amount,
+                self.adjust_flag, self.turn, int(self.trade_status), self.pctChg, self.peTTM,
+                self.psTTM, self.pcfNcfTTM, self.pbMRQ, int(self.isST))
+
     def __str__(self):
         return '{}({})  {:6.2f}  {:6.2f}  {:6.2f}  {:6.2f}  {:10d}  {:5.2f}  {:.0f}  {}'. \
             format(self.date_str, get_weekday(self.date_str)[1], self.open, self.close,
                    self.high, self.low, self.volume, self.turn, self.amount, self.trade_status)
 
 
-class DataRt:
+class DataRt(SlotsRecord):
+    __slots__ = ('date', 'time', 'code', 'open', 'pre_close', 'new', 'high', 'low', 'volume', 'amount',
+                 'b1n', 'b1v', 'b2n', 'b2v', 'b3n', 'b3v', 'b4n', 'b4v', 'b5n', 'b5v',
+                 's1n', 's1v', 's2n', 's2v', 's3n', 's3v', 's4n', 's4v', 's5n', 's5v')
     FMT_RT_HEX = '<LLLfffLfLfLfLfLfLfLfLfLfLfLf'
     RT_HEX_LEN = 4*28
+    RT_NAMES = ['date', 'time', 'code', 'new', 'high', 'low', 'volume', 'amount',
+                'b1n', 'b1v', 'b2n', 'b2v', 'b3n', 'b3v', 'b4n', 'b4v', 'b5n', 'b5v',
+                's1n', 's1v', 's2n', 's2v', 's3n', 's3v', 's4n', 's4v', 's5n', 's5v']
+    DTYPE = hex_fmt_dtype(FMT_RT_HEX, RT_NAMES)
 
     def __init__(self, date, time, code, open, pre_close, new, high, low, volume, amount,
                  b1v, b1n, b2v, b2n, b3v, b3n, b4v, b4n, b5v, b5n,
@@ -595,6 +997,16 @@ class DataRt:
             self.b4n, self.b4v, self.s4n, self.s4v = int(b4n), float(b4v), int(s4n), float(s4v)
             self.b5n, self.b5v, self.s5n, self.s5v = int(b5n), float(b5v), int(s5n), float(s5v)
 
+    def to_hex(self, fmt=FMT_RT_HEX):
+        # open and pre_close are not part of FMT_RT_HEX
+        return pack(fmt, *[getattr(self, name) for name in DataRt.RT_NAMES])
+
+    @staticmethod
+    def from_np(row):
+        v = dict(zip(DataRt.RT_NAMES, row.item()))
+        v.update(open=0, pre_close=0)
+        return DataRt(**v)
+
     def __str__(self):
         return (
                 '{}{:06d}  {:06d}  {:5.2f} {:5.2f} {:5.2f} {:7d} {:11.1f} | ' + ' {:5.2f} {:5d}'*5 + ' |' + ' {:5.2f} {:5d}'*5). \
@@ -742,6 +1154,14 @@ class StockRtData:
     sub_cb = None  # func(DataRt, value_change, volume_change, user_param)
     interval = None
     param = None
+    RT_URL = 'http://hq.sinajs.cn/?list={}'
+    CHUNK_SIZE = 256
+    FETCH_WORKERS = 8
+    FETCH_TIMEOUT = (3, 5)  # connect, read seconds of one chunk
+    session = None  # keep-alive connections shared by the fetch threads
+    executor = None
+    fetch_lock = Lock()
+    failed = []  # codes of the chunks missing from the last get()
 
     @staticmethod
     def _sub_cb(result_data):
@@ -757,32 +1177,57 @@ class StockRtData:
                 StockRtData.sub_cb(rt, False, False, StockRtData.param)
 
     @staticmethod
-    def get(stocks_list):
+    def _fetch_pool():
+        with StockRtData.fetch_lock:
+            if StockRtData.session is None:
+                StockRtData.session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=StockRtData.FETCH_WORKERS)
+                StockRtData.session.mount('http://', adapter)
+                StockRtData.session.mount('https://', adapter)
+                StockRtData.executor = ThreadPoolExecutor(StockRtData.FETCH_WORKERS)
+            return StockRtData.session, StockRtData.executor
+
+    @staticmethod
+    def _get_chunk(session, chunk):
+        r = session.get(StockRtData.RT_URL.format(','.join(chunk)), timeout=StockRtData.FETCH_TIMEOUT)
+        ret = r.content.decode(encoding='gbk')
         res = []
-        for i in range(0, len(stocks_list), 256):
+        for line in ret.strip().split('\n'):
             try:
-                r = requests.get('http://hq.sinajs.cn/?list={}'.format(','.join(stocks_list[i:min(len(stocks_list), i+256)])))
-                ret = r.content.decode(encoding='gbk')
-                for line in ret.strip().split('\n'):
-                    try:
-                        context = line.split('"')
-                        p = context[1].split(',')
-                        res.append(
-                            DataRt(
-                                date=p[30][2:4] + p[30][5:7] + p[30][8:10],
-                                time=p[31][0:2] + p[31][3:5] + p[31][6:8],
-                                open=p[1], pre_close=p[2],
-                                code=context[0][-7:-1], new=p[3], high=p[4], low=p[5], volume=p[8], amount=p[9],
-                                b1v=p[11], b1n=p[10], b2v=p[13], b2n=p[12], b3v=p[15], b3n=p[14], b4v=p[17], b4n=p[16], b5v=p[19], b5n=p[18],
-                                s1v=p[21], s1n=p[20], s2v=p[23], s2n=p[22], s3v=p[25], s3n=p[24], s4v=p[27], s4n=p[26], s5v=p[29], s5n=p[28],
-                            )
-                        )
-                    except IndexError:
-                        pass
-            except:
+                context = line.split('"')
+                p = context[1].split(',')
+                res.append(
+                    DataRt(
+                        date=p[30][2:4] + p[30][5:7] + p[30][8:10],
+                        time=p[31][0:2] + p[31][3:5] + p[31][6:8],
+                        open=p[1], pre_close=p[2],
+                        code=context[0][-7:-1], new=p[3], high=p[4], low=p[5], volume=p[8], amount=p[9],
+                        b1v=p[11], b1n=p[10], b2v=p[13], b2n=p[12], b3v=p[15], b3n=p[14], b4v=p[17], b4n=p[16], b5v=p[19], b5n=p[18],
+                        s1v=p[21], s1n=p[20], s2v=p[23], s2n=p[22], s3v=p[25], s3n=p[24], s4v=p[27], s4n=p[26], s5v=p[29], s5n=p[28],
+                    )
+                )
+            except IndexError:
                 pass
         return res
 
+    @staticmethod
+    def get(stocks_list, timeout=None):
+        # all chunks are fetched in parallel, the ones failed or not finished within timeout seconds
+        # are left out of the result and their codes kept in StockRtData.failed
+        session, executor = StockRtData._fetch_pool()
+        chunks = [stocks_list[i:i+StockRtData.CHUNK_SIZE] for i in range(0, len(stocks_list), StockRtData.CHUNK_SIZE)]
+        futures = [executor.submit(StockRtData._get_chunk, session, chunk) for chunk in chunks]
+        done, _ = wait(futures, timeout)
+        res = []
+        failed = []
+        for future, chunk in zip(futures, chunks):
+            if future in done and future.exception() is None:
+                res += future.result()
+            else:
+                failed += chunk
+        StockRtData.failed = failed
+        return res
+
     @staticmethod
     def get_recent_k5(code, start=0, end=2111111111):
         KLINE_TT_MIN_URL = 'http://ifzq.gtimg.cn/appstock/app/kline/mkline?param=%s,m5,,640&_var=m5_today&r=0.%s'
@@ -871,22 +1316,29 @@ class StockRtData:
             if len(h) == len(name_list) and min([ name in item for name, item in zip(name_list, h) ]):
                 return True
         url = 'http://vip.stock.finance.sina.com.cn/q/go.php/vFinanceAnalyze/kind/mainindex/index.phtml?s_i=&s_a=&s_c=&reportdate=%d&quarter=%d&num=10000'
+        def build_row(line):
+            # the first row is the header, the others become DataReport as they are parsed
+            if len(header) == 0:
+                header.append(line)
+                return None
+            try:
+                int(line[0])
+                return DataReport(line[0], *line[2:11], year, quarter)
+            except:
+                return None
         res = {}
         for _ in range(retry_count):
             time.sleep(0.01)
             try:
-                r = requests.get(url%(year, quarter))
-                html_text = r.content.decode(encoding='gbk')
-                if len(html_text) < 512:
+                header = []
+                r = requests.get(url%(year, quarter), stream=True)
+                parser, length = HtmlTables.from_response(r, 'gbk', build_row)
+                if length < 512:
                     break
-                tables = html_get_tables(html_text)
-                if len(tables) != 1 or len(tables[0]) < 2 or not check_header(tables[0][0]):
+                if len(parser.tables) != 1 or not check_header(header[0]):
                     return None
-                for line in tables[0][1:]:
-                    try:
-                        res[int(line[0])] = DataReport(line[0], *line[2:11], year, quarter)
-                    except:
-                        pass
+                for report in parser.tables[0]:
+                    res[report.code] = report
                 break
             except Exception as e:
                 pass
@@ -1045,15 +1497,794 @@ class StockRtData:
                     callback(r, value_change, volume_change, user_param)
         StockRtData.subscribe(stock_list, rec_cb, interval, measure_time, param=param)
 
+    @staticmethod
+    def to_bin(stock_list, callback=None, param=None, interval=10, measure_time=(5, 30, 0)):
+        # same as to_csv, the changed records go to StockRtRecorder day files
+        if len(stock_list) == 0:
+            return
+        stock_list = [StockBasicInfo.code2sina(s) for s in stock_list]
+        recorder = StockRtRecorder()
+
+        def rec_cb(r, value_change, volume_change, user_param):
+            if value_change or volume_change:
+                recorder.add(r)
+                if callback is not None:
+                    callback(r, value_change, volume_change, user_param)
+        try:
+            StockRtData.subscribe(stock_list, rec_cb, interval, measure_time, param=param)
+        finally:
+            recorder.close()
+
+
+class StockRtSubscriber:
+    # bounded queue of DataRt batches of one StockRtBus consumer, when it is full a new batch:
+    #   POLICY_DROP_OLDEST: replaces the oldest queued batch
+    #   POLICY_DROP_NEWEST: is dropped
+    #   POLICY_COALESCE: is merged into the newest queued batch, keeping the latest record of every code
+    POLICY_DROP_OLDEST = 0
+    POLICY_DROP_NEWEST = 1
+    POLICY_COALESCE = 2
+
+    def __init__(self, maxsize=16, policy=POLICY_COALESCE):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = deque()
+        self.cond = Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, batch):
+        with self.cond:
+            if self.closed:
+                return
+            if len(self.queue) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == StockRtSubscriber.POLICY_DROP_NEWEST:
+                    return
+                elif self.policy == StockRtSubscriber.POLICY_COALESCE:
+                    merged = {rt.code: rt for rt in self.queue[-1]}
+                    merged.update((rt.code, rt) for rt in batch)
+                    self.queue[-1] = list(merged.values())
+                    self.cond.notify()
+                    return
+                self.queue.popleft()
+            self.queue.append(batch)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        # next batch, None once closed and drained or after timeout seconds
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.queue) > 0 or self.closed, timeout)
+            return self.queue.popleft() if len(self.queue) > 0 else None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __iter__(self):
+        while True:
+            batch = self.get()
+            if batch is None:
+                return
+            yield batch
+
+
+class StockRtBus:
+    # one background poller of StockRtData.get fanned out to any number of StockRtSubscriber,
+    # e.g. bus = StockRtBus(codes).start(); sub = bus.subscribe(); for batch in sub: ...; bus.stop()
+    def __init__(self, sub_list, interval=10, measure_time=(5, 30, 0)):
+        self.sub_list = [StockBasicInfo.code2sina(s) for s in sub_list]
+        self.interval = interval
+        self.finish_time = time.time() + measure_time[0] * 3600 + measure_time[1] * 60 + measure_time[2]
+        self.subscribers = []
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.thread = None
+        self.callback_threads = []
+
+    def subscribe(self, maxsize=16, policy=StockRtSubscriber.POLICY_COALESCE):
+        sub = StockRtSubscriber(maxsize, policy)
+        with self.lock:
+            self.subscribers.append(sub)
+        return sub
+
+    def subscribe_cb(self, callback, param=None, maxsize=16, policy=StockRtSubscriber.POLICY_COALESCE):
+        # callback(batch, param) is called from its own thread, a slow callback only delays itself
+        sub = self.subscribe(maxsize, policy)
+
+        def _consume():
+            for batch in sub:
+                callback(batch, param)
+        th = Thread(target=_consume, daemon=True)
+        th.start()
+        self.callback_threads.append(th)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+        sub.close()
+
+    def publish(self, batch):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for sub in subscribers:
+            sub.put(batch)
+
+    def _poll(self):
+        while not self.stop_event.is_set() and time.time() < self.finish_time:
+            start = time.time()
+            batch = StockRtData.get(self.sub_list, timeout=self.interval)
+            if len(batch) > 0:
+                self.publish(batch)
+            self.stop_event.wait(max(0, self.interval - (time.time() - start)))
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for sub in subscribers:
+            sub.close()
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = Thread(target=self._poll, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self, join=True):
+        # stops polling and closes all subscribers, their consumers get None after the queued batches
+        self.stop_event.set()
+        if join and self.thread is not None:
+            self.thread.join()
+            for th in self.callback_threads:
+                th.join()
+        return self
+
+
+class StockRtRecorder:
+    # DataRt records of a whole day appended to '<yymmdd>.rt.dat' (FMT_HEX) in the database path.
+    # records are buffered and written in batches, once BUFFER_SIZE bytes are pending and at the latest
+    # FLUSH_INTERVAL seconds after they were added: a background thread flushes while no records arrive
+    FLUSH_INTERVAL = 5
+    BUFFER_SIZE = 1024 * 1024
+    FMT_HEX = '<LLLfffQf' + 'Lf' * 10  # DataRt.FMT_RT_HEX with an uint64 volume, index volumes overflow uint32
+    HEX_LEN = 4*29
+    DTYPE = hex_fmt_dtype(FMT_HEX, DataRt.RT_NAMES)
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, buffer_size=BUFFER_SIZE):
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.buffers = {}  # date -> bytearray
+        self.buffered = 0
+        self.last_flush = time.time()
+        self.lock = Lock()
+        self.dropped = 0
+        self.stop_event = Event()
+        self.thread = Thread(target=self._flush_loop, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def path(date):
+        return UtilsConfig.get_stock_data_path('{:06d}'.format(int(date)), stock_type='rt')
+
+    def _flush_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            with self.lock:
+                if self.buffered > 0 and time.time() - self.last_flush >= self.flush_interval:
+                    self._flush()
+
+    def add(self, rt_list):
+        with self.lock:
+            for rt in (rt_list if isinstance(rt_list, list) else [rt_list]):
+                try:
+                    data = rt.to_hex(StockRtRecorder.FMT_HEX)
+                except StructError as e:  # a value out of range only loses its own record
+                    self.dropped += 1
+                    print('Record dropped: {:06d} {} {}'.format(rt.code, rt.time, e))
+                    continue
+                self.buffers.setdefault(rt.date, bytearray()).extend(data)
+                self.buffered += StockRtRecorder.HEX_LEN
+            if self.buffered >= self.buffer_size or time.time() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        for date, buf in self.buffers.items():
+            path = StockRtRecorder.path(date)
+            if path is not None and len(buf) > 0:
+                with open(path, 'ab') as f:
+                    f.write(buf)
+        self.buffers = {}
+        self.buffered = 0
+        self.last_flush = time.time()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+        return self
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        return self.flush()
+
+    @staticmethod
+    def load(date, code=None, np_mode=True):
+        # records of a day in time order, of one code (int) if given; DataRt objects have open/pre_close 0
+        path = StockRtRecorder.path(date)
+        if path is None or not os.path.isfile(path):
+            return np.zeros(0, dtype=StockRtRecorder.DTYPE) if np_mode else []
+        data = np.fromfile(path, dtype=StockRtRecorder.DTYPE, count=os.path.getsize(path) // StockRtRecorder.HEX_LEN)
+        if code is not None:
+            data = data[data['code'] == int(code)]
+        data = data[np.argsort(data['time'], kind='stable')]
+        return data if np_mode else [DataRt.from_np(row) for row in data]
+
+
+class DataIndex:
+    FMT_HEX = '<LLL'
+    HEX_LEN = 4*3
+    DTYPE = hex_fmt_dtype(FMT_HEX, ['date', 'offset', 'count'])
+
+
+class StockDataIndex:
+    # sidecar '<code>.<type>.idx.dat' next to the data file: one DataIndex(date_num, byte offset, record count)
+    # per run of records sharing a date, in file order
+    REC_DTYPE = {'kd': DataD.DTYPE, 'k5': Data5.DTYPE}
+    DATE_DIV = {'kd': 1, 'k5': 10000}
+
+    def __init__(self, code, stock_type='k5'):
+        self.code = code
+        self.stock_type = stock_type
+        self.rec_len = StockDataIndex.REC_DTYPE[stock_type].itemsize
+        self.data_path = UtilsConfig.get_stock_data_path(code, stock_type=stock_type)
+        self.path = UtilsConfig.get_stock_data_path(code, stock_type=stock_type + '.idx')
+
+    def group(self, offset, date_num):
+        # consecutive records with the same date -> DataIndex array, offset is the byte offset of date_num[0]
+        date_num = np.asarray(date_num, dtype=np.uint32)
+        starts = np.flatnonzero(np.diff(date_num, prepend=np.uint32(0)) != 0)
+        index = np.zeros(len(starts), dtype=DataIndex.DTYPE)
+        index['date'] = date_num[starts]
+        index['offset'] = offset + starts * self.rec_len
+        index['count'] = np.diff(np.append(starts, len(date_num)))
+        return index
+
+    def indexed_size(self, index):
+        return 0 if len(index) == 0 else int(index['offset'][-1]) + int(index['count'][-1]) * self.rec_len
+
+    def load(self):
+        # returns None if there is no index or it does not cover the data file
+        if self.path is None or not os.path.isfile(self.path) or not os.path.isfile(self.data_path):
+            return None
+        index = np.fromfile(self.path, dtype=DataIndex.DTYPE)
+        if self.indexed_size(index) != os.path.getsize(self.data_path):
+            return None
+        return index
+
+    def build(self):
+        if self.path is None or not os.path.isfile(self.data_path):
+            return None
+        dtype = StockDataIndex.REC_DTYPE[self.stock_type]
+        data = np.fromfile(self.data_path, dtype=dtype, count=os.path.getsize(self.data_path) // self.rec_len)
+        index = self.group(0, data[dtype.names[0]] // StockDataIndex.DATE_DIV[self.stock_type])
+        with open(self.path + '.tmp', 'wb') as f:
+            index.tofile(f)
+        os.replace(self.path + '.tmp', self.path)
+        return index
+
+    def append(self, offset, date_num):
+        # records with date_num were appended to the data file at byte offset
+        if self.path is None or not os.path.isfile(self.path):
+            return self.build()
+        index = np.fromfile(self.path, dtype=DataIndex.DTYPE)
+        if self.indexed_size(index) != offset:
+            return self.build()
+        new_index = self.group(offset, date_num)
+        if len(new_index) == 0:
+            return index
+        with open(self.path, 'r+b') as f:
+            f.seek(0, 2)
+            if len(index) > 0 and index['date'][-1] == new_index['date'][0]:  # continue a partial day
+                new_index['offset'][0] = index['offset'][-1]
+                new_index['count'][0] += index['count'][-1]
+                f.seek(-DataIndex.HEX_LEN, 2)
+                index = index[:-1]
+            new_index.tofile(f)
+        return np.concatenate([index, new_index])
+
+
+class StockArchive:
+    # closed years of k5 history in '<code>.k5.<yy>z.dat', one chunk per trading day:
+    # '<LLL' (date_num, bar count, payload size) + zlib payload of the per-column deltas of the Data5 records
+    CHUNK_FMT = '<LLL'
+    CHUNK_LEN = 4*3
+
+    def __init__(self, code):
+        self.code = code
+        self.hot_path = UtilsConfig.get_stock_data_path(code, stock_type='k5')
+
+    def path(self, year):
+        return UtilsConfig.get_stock_data_path(self.code, stock_type='k5.{:02d}z'.format(year % 100))
+
+    @staticmethod
+    def encode(data):
+        cols = data.view('<u4').reshape(len(data), -1)  # every Data5 field is 4 bytes wide
+        delta = np.diff(cols, axis=0, prepend=np.zeros((1, cols.shape[1]), dtype='<u4'))
+        return zlib.compress(delta.T.tobytes(), 9)
+
+    @staticmethod
+    def decode(payload, count):
+        delta = np.frombuffer(zlib.decompress(payload), dtype='<u4').reshape(-1, count).T
+        cols = np.ascontiguousarray(np.cumsum(delta, axis=0, dtype='<u4'))
+        return cols.view(Data5.DTYPE).reshape(count)
+
+    def hot_first_date(self):
+        if self.hot_path is None or not os.path.isfile(self.hot_path) or os.path.getsize(self.hot_path) < 4:
+            return 1000000
+        with open(self.hot_path, 'rb') as f:
+            return unpack('<L', f.read(4))[0] // 10000
+
+    def archive(self, year, remove=False):
+        # compress year (e.g. 19) of the hot k5 file, with remove the year is cut from the head of the hot file
+        year %= 100
+        if self.hot_path is None or not os.path.isfile(self.hot_path):
+            return 0
+        size = os.path.getsize(self.hot_path)
+        with open(self.hot_path, 'rb') as f:
+            first, last = StockData.seek_hex(f, size, Data5.HEX_LEN, size // Data5.HEX_LEN,
+                                             year * 10000 + 101, year * 10000 + 1231, 10000)
+            f.seek(first * Data5.HEX_LEN)
+            data = np.fromfile(f, dtype=Data5.DTYPE, count=last - first)
+        if len(data) == 0:
+            return 0
+        index = StockDataIndex(self.code, 'k5').group(0, data['time'] // 10000)
+        path = self.path(year)
+        with open(path + '.tmp', 'wb') as f:
+            for date, offset, count in index:
+                rec = offset // Data5.HEX_LEN
+                payload = StockArchive.encode(data[rec:rec + count])
+                f.write(pack(StockArchive.CHUNK_FMT, date, count, len(payload)))
+                f.write(payload)
+        os.replace(path + '.tmp', path)
+        if remove:
+            if first != 0 or last * Data5.HEX_LEN == size:
+                print('Archive {} {}: only a closed year at the head of the hot file can be removed'.format(
+                    self.code, year))
+            else:
+                with open(self.hot_path, 'rb') as f_in, open(self.hot_path + '.tmp', 'wb') as f_out:
+                    f_in.seek(last * Data5.HEX_LEN)
+                    f_out.write(f_in.read())
+                os.replace(self.hot_path + '.tmp', self.hot_path)
+                StockDataIndex(self.code, 'k5').build()
+        return len(index)
+
+    def load_k5(self, start_date=0, end_date=999999, np_mode=False, days=None, before_date=1000000):
+        # same structures as StockData.load_k5: list of days of Data5, or a (days, 48) array of full days,
+        # `days` counts back from the last archived day older than before_date.
+        # archives are consecutive years: they are walked back from the last needed one reading only the
+        # chunk headers, until `days` chunks are found, a year is missing or start_date is passed
+        first_year = max(start_date // 10000, int(StockData.NEW_FILE_DATE[:2]))
+        last_year = min(end_date, before_date - 1, Date.get_now()) // 10000
+        chunks = []  # (date, count, path, payload offset, payload size)
+        for year in range(last_year, first_year - 1, -1):
+            path = self.path(year)
+            if path is None or not os.path.isfile(path):
+                if len(chunks) > 0:
+                    break
+                continue
+            year_chunks = []
+            file_size = os.path.getsize(path)
+            with open(path, 'rb') as f:
+                pos = 0
+                while pos + StockArchive.CHUNK_LEN <= file_size:
+                    f.seek(pos)
+                    date, count, size = unpack(StockArchive.CHUNK_FMT, f.read(StockArchive.CHUNK_LEN))
+                    pos += StockArchive.CHUNK_LEN
+                    if date < before_date:
+                        year_chunks.append((date, count, path, pos, size))
+                    pos += size
+            chunks = year_chunks + chunks
+            if days is not None and len(chunks) >= days:
+                break
+        if days is not None:
+            chunks = chunks[max(0, len(chunks) - days):]
+        days = []
+        f, f_path = None, None
+        for date, count, path, offset, size in chunks:
+            if not start_date <= date <= end_date:
+                continue
+            if path != f_path:
+                if f is not None:
+                    f.close()
+                f, f_path = open(path, 'rb'), path
+            f.seek(offset)
+            days.append(StockArchive.decode(f.read(size), count))
+        if f is not None:
+            f.close()
+        if np_mode:
+            days = [d for d in days if len(d) == 48]
+            return np.stack(days) if len(days) > 0 else np.zeros((0, 48), dtype=Data5.DTYPE)
+        return [[Data5(*r.item()) for r in d] for d in days]
+
+
+class StockManifest:
+    # code -> {stock_type: (last date_num of kd / last time of k5, record count, file size)}
+    # lets the update path and check_update_failed know the tail of every data file without opening it
+    def __init__(self, file_name='data_manifest.db'):
+        self.path = UtilsConfig.get_stock_list_path(file_name)
+        self.items = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self.items = pickle.load(f)
+        except:
+            self.items = {}
+        return self
+
+    def save(self):
+        if self.path is not None:
+            with open(self.path + '.tmp', 'wb') as f:
+                pickle.dump(self.items, f)
+            os.replace(self.path + '.tmp', self.path)
+        return self
+
+    def get(self, code, stock_type):
+        # the entry is only trusted while the file size still matches
+        item = self.items.get(code, {}).get(stock_type)
+        path = UtilsConfig.get_stock_data_path(code, stock_type=stock_type)
+        if item is None or path is None or not os.path.isfile(path) or os.path.getsize(path) != item[2]:
+            return None
+        return item
+
+    def put(self, code, stock_type, last, rec_num, size):
+        self.items.setdefault(code, {})[stock_type] = (last, rec_num, size)
+        return self
+
+    def update(self, code, stock_type):
+        # refresh one entry from the data file
+        path = UtilsConfig.get_stock_data_path(code, stock_type=stock_type)
+        rec_len = DataD.HEX_LEN if stock_type == 'kd' else Data5.HEX_LEN
+        if path is None or not os.path.isfile(path) or os.path.getsize(path) < rec_len:
+            self.items.get(code, {}).pop(stock_type, None)
+            return None
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            f.seek(size // rec_len * rec_len - rec_len)
+            last = unpack('<L', f.read(4))[0]
+        self.put(code, stock_type, last, size // rec_len, size)
+        return self.items[code][stock_type]
+
+
+class StockBars:
+    # derived bars cached as '<code>.<type>.dat' next to kd/k5, k15/k30/k60 in Data5 and kw/km in DataD format
+    TYPES = {'k15': ('k5', 15), 'k30': ('k5', 30), 'k60': ('k5', 60), 'kw': ('kd', 'w'), 'km': ('kd', 'm')}
+    K5_TYPES = ['k15', 'k30', 'k60']
+    KD_TYPES = ['kw', 'km']
+
+    def __init__(self, code):
+        self.code = code
+
+    @staticmethod
+    def date_to_days(date_num):
+        # yymmdd -> days since 1970-01-01
+        date_num = np.asarray(date_num, dtype=np.int64)
+        month = (2000 + date_num // 10000 - 1970) * 12 + date_num // 100 % 100 - 1
+        return (month.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + date_num % 100 - 1)
+
+    @staticmethod
+    def period_key(stock_type, data):
+        # id of the period every source record belongs to
+        src, period = StockBars.TYPES[stock_type]
+        if src == 'k5':
+            hhmm = data['time'].astype(np.int64) % 10000
+            minute = hhmm // 100 * 60 + hhmm % 100
+            minute = np.where(minute <= 11 * 60 + 30, minute - (9 * 60 + 30), minute - 13 * 60 + 120)
+            return data['time'].astype(np.int64) // 10000 * 100 + (minute + period - 1) // period
+        if period == 'w':
+            return (StockBars.date_to_days(data['date']) + 3) // 7  # 1970-01-01 is a Thursday
+        return data['date'].astype(np.int64) // 100
+
+    @staticmethod
+    def period_start(stock_type, date_num):
+        # first possible date_num of the period containing date_num
+        src, period = StockBars.TYPES[stock_type]
+        if src == 'k5':
+            return date_num
+        if period == 'w':
+            return Date.get_day(date_num, -int((StockBars.date_to_days(date_num) + 3) % 7))  # back to monday
+        return date_num // 100 * 100 + 1
+
+    @staticmethod
+    def aggregate(stock_type, data):
+        # vectorised OHLC of the source records per period, volume and amount summed
+        if len(data) == 0:
+            return np.zeros(0, dtype=data.dtype)
+        key = StockBars.period_key(stock_type, data)
+        starts = np.flatnonzero(np.diff(key, prepend=key[0] - 1) != 0)
+        ends = np.append(starts[1:], len(data)) - 1
+        bars = data[ends].copy()  # time/date and the day fields of the last record
+        bars['open'] = data['open'][starts]
+        bars['high'] = np.maximum.reduceat(data['high'], starts)
+        bars['low'] = np.minimum.reduceat(data['low'], starts)
+        bars['volume'] = np.add.reduceat(data['volume'], starts)
+        bars['amount'] = np.add.reduceat(data['amount'].astype(np.float64), starts)
+        if StockBars.TYPES[stock_type][0] == 'kd':
+            bars['turn'] = np.add.reduceat(data['turn'].astype(np.float64), starts)
+            bars['pctChg'] = (np.multiply.reduceat(1 + data['pctChg'].astype(np.float64) / 100, starts) - 1) * 100
+        return bars
+
+    def update(self, stock_types):
+        # recompute from the first day of the last cached period, which may have been incomplete
+        for stock_type in stock_types:
+            src = StockBars.TYPES[stock_type][0]
+            dtype = DataD.DTYPE if src == 'kd' else Data5.DTYPE
+            path = UtilsConfig.get_stock_data_path(self.code, stock_type=stock_type)
+            src_path = UtilsConfig.get_stock_data_path(self.code, stock_type=src)
+            if path is None or src_path is None or not os.path.isfile(src_path):
+                continue
+            date_div = 10000 if src == 'k5' else 1
+            bar_num = os.path.getsize(path) // dtype.itemsize if os.path.isfile(path) else 0
+            start_date = 0
+            if bar_num > 0:
+                with open(path, 'rb') as f:
+                    f.seek((bar_num - 1) * dtype.itemsize)
+                    start_date = StockBars.period_start(stock_type, unpack('<L', f.read(4))[0] // date_div)
+                    bar_num = StockData.seek_hex(f, bar_num * dtype.itemsize, dtype.itemsize, bar_num,
+                                                 start_date, date_div=date_div)[0]
+            size = os.path.getsize(src_path)
+            with open(src_path, 'rb') as f:
+                first, last = StockData.seek_hex(f, size, dtype.itemsize, size // dtype.itemsize, start_date,
+                                                 date_div=date_div)
+                f.seek(first * dtype.itemsize)
+                data = np.fromfile(f, dtype=dtype, count=last - first)
+            if src == 'kd':
+                data = data[data['trade_status'] == StockTradeStatus.ON]
+            else:
+                data = data[data['open'] >= 0.1]
+            bars = StockBars.aggregate(stock_type, data)
+            with open(path, 'ab') as f:
+                f.truncate(bar_num * dtype.itemsize)
+                f.write(bars.tobytes())
+
+    def load(self, stock_type, days, start_date=0, end_date=999999, np_mode=False):
+        # last `days` bars of a derived type, as DataD/Data5 objects or a structured array
+        path = UtilsConfig.get_stock_data_path(self.code, stock_type=stock_type)
+        src = StockBars.TYPES[stock_type][0]
+        dtype = DataD.DTYPE if src == 'kd' else Data5.DTYPE
+        if path is None or not os.path.isfile(path):
+            return np.zeros(0, dtype=dtype) if np_mode else []
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            first, last = StockData.seek_hex(f, size, dtype.itemsize, days, start_date, end_date,
+                                             10000 if src == 'k5' else 1)
+            f.seek(first * dtype.itemsize)
+            data = np.fromfile(f, dtype=dtype, count=last - first)
+        if np_mode:
+            return data
+        return [DataD.from_np(row) if src == 'kd' else Data5.from_np(row) for row in data]
+
+
+class DataAdjust:
+    FMT_HEX = '<Lfff'
+    HEX_LEN = 4*4
+    DTYPE = hex_fmt_dtype(FMT_HEX, ['date', 'fore', 'back', 'factor'])
+
+    def __init__(self, code, divid_date, fore, back, factor):
+        # ['sh.600000', '2018-07-13', '0.936525', '9.924279', '9.924279']
+        self.code = code
+        # events of the last century only matter as the factor in effect at 000101
+        self.date_num = int(divid_date[2:4] + divid_date[5:7] + divid_date[8:10]) if divid_date >= '2000' else 0
+        self.fore, self.back, self.factor = float(fore), float(back), float(factor)
+
+
+class StockAdjust:
+    # adjust factors of baostock.query_adjust_factor cached as '<code>.adj.dat' next to the kd file.
+    # Only the back factors are used: they never change once published, the fore factors are derived
+    # from the latest one at load time, so the cache stays valid when new events are appended.
+    FQT_NONE = 0
+    FQT_FRONT = 1  # 前复权
+    FQT_BACK = 2   # 后复权
+    PRICE_FIELDS = ['open', 'close', 'high', 'low']
+
+    def __init__(self, code):
+        self.code = code
+        self.path = UtilsConfig.get_stock_data_path(code, stock_type='adj')
+        self.events = None
+
+    def update(self):
+        if self.path is None:
+            return
+        events = self.load()
+        if len(events) == 0:
+            start_date = '1990-01-01'
+        elif events['date'][-1] == 0:
+            start_date = '2000-01-01'
+        else:
+            start_date = '20{:06d}'.format(Date.get_day(int(events['date'][-1]), 1))
+            start_date = '{}-{}-{}'.format(start_date[0:4], start_date[4:6], start_date[6:8])
+        adjust_list = Stock.query_adjust_factor(self.code, start_date)
+        if adjust_list is None or len(adjust_list) == 0:
+            return
+        with open(self.path, 'ab') as f:
+            for item in adjust_list:
+                adj = DataAdjust(*item)
+                f.write(pack(DataAdjust.FMT_HEX, adj.date_num, adj.fore, adj.back, adj.factor))
+        self.events = None
+
+    def load(self):
+        if self.events is None:
+            if self.path is not None and os.path.isfile(self.path):
+                self.events = np.fromfile(self.path, dtype=DataAdjust.DTYPE)
+            else:
+                self.events = np.zeros(0, dtype=DataAdjust.DTYPE)
+        return self.events
+
+    def factors(self, date_num, fqt=FQT_FRONT):
+        # price multiplier for every date_num, 1.0 before the first event
+        events = self.load()
+        date_num = np.asarray(date_num)
+        if fqt == StockAdjust.FQT_NONE or len(events) == 0:
+            return np.ones(date_num.shape)
+        idx = np.searchsorted(events['date'], date_num, 'right') - 1
+        back = np.where(idx >= 0, events['back'][np.maximum(idx, 0)].astype(np.float64), 1.0)
+        if fqt == StockAdjust.FQT_FRONT:
+            return back / float(events['back'][-1])
+        return back
+
+    def adjust_np(self, data, fqt=FQT_FRONT):
+        # adjusted copy of a DataD.DTYPE or Data5.DTYPE array of any shape
+        if fqt == StockAdjust.FQT_NONE:
+            return data
+        date_num = data['date'] if 'date' in data.dtype.names else data['time'] // 10000
+        factor = self.factors(date_num, fqt)
+        data = data.copy()
+        for name in StockAdjust.PRICE_FIELDS:
+            data[name] = data[name] * factor
+        return data
+
+    def adjust_list(self, data_list, fqt=FQT_FRONT):
+        # adjusts DataD objects or k5 day lists of Data5 objects in place
+        if fqt == StockAdjust.FQT_NONE or len(data_list) == 0:
+            return data_list
+        items = [x for day in data_list for x in day] if isinstance(data_list[0], list) else data_list
+        factor = self.factors([x.date_num for x in items], fqt)
+        for x, f in zip(items, factor.tolist()):
+            x.open, x.close, x.high, x.low = x.open * f, x.close * f, x.high * f, x.low * f
+        return data_list
+
+
+def _integrity_scan(code, stock_type, calendar):
+    return StockIntegrity.scan(code, stock_type, calendar)
+
+
+class StockIntegrity:
+    # consistency of the kd/k5 files: the record keys have to be sorted and unique, every k5 day complete
+    # and every trading day of the calendar (kd of CALENDAR_CODE) present between the first and last record
+    CALENDAR_CODE = 'sh.000001'
+    REC_DTYPE = {'kd': DataD.DTYPE, 'k5': Data5.DTYPE}
+    KEY = {'kd': 'date', 'k5': 'time'}
+    PRICE_FIELDS = ['open', 'close', 'high', 'low']
+
+    @staticmethod
+    def read(code, stock_type):
+        path = UtilsConfig.get_stock_data_path(code, stock_type=stock_type)
+        if path is None or not os.path.isfile(path):
+            return None, 0
+        dtype = StockIntegrity.REC_DTYPE[stock_type]
+        size = os.path.getsize(path)
+        return np.fromfile(path, dtype=dtype, count=size // dtype.itemsize), size % dtype.itemsize
+
+    @staticmethod
+    def calendar(code=CALENDAR_CODE):
+        data, _ = StockIntegrity.read(code, 'kd')
+        if data is None:
+            return np.zeros(0, dtype=np.uint32)
+        return np.unique(data['date'][data['trade_status'] == StockTradeStatus.ON])
+
+    @staticmethod
+    def scan(code, stock_type, calendar=None):
+        # returns None without a data file, a dict of the problems found otherwise
+        data, size_error = StockIntegrity.read(code, stock_type)
+        if data is None:
+            return None
+        key = data[StockIntegrity.KEY[stock_type]]
+        report = {'code': code, 'type': stock_type, 'records': len(data), 'size_error': size_error,
+                  'unsorted': int(np.count_nonzero(np.diff(key.astype(np.int64)) < 0)),
+                  'duplicates': len(key) - len(np.unique(key)),
+                  'bad_days': [], 'gaps': [], 'zero_price': 0}
+        if stock_type == 'kd':
+            on = data['trade_status'] == StockTradeStatus.ON
+            dates = np.unique(key)
+        else:
+            kd, _ = StockIntegrity.read(code, 'kd')
+            on = np.ones(len(data), dtype=bool)
+            dates, counts = np.unique(key // 10000, return_counts=True)
+            report['bad_days'] = dates[counts != 48].tolist()
+            if kd is not None and len(kd) > 0:  # a suspended stock has no bars, its own kd is the calendar
+                calendar = np.unique(kd['date'][kd['trade_status'] == StockTradeStatus.ON])
+        zero = np.zeros(len(data), dtype=bool)
+        for name in StockIntegrity.PRICE_FIELDS:
+            zero |= data[name] <= 0
+        report['zero_price'] = int(np.count_nonzero(zero & on))
+        if calendar is not None and len(dates) > 0:
+            calendar = calendar[(dates[0] <= calendar) & (calendar <= dates[-1])]
+            report['gaps'] = np.setdiff1d(calendar, dates).tolist()
+        return report
+
+    @staticmethod
+    def is_clean(report):
+        return report is None or not (report['size_error'] or report['unsorted'] or report['duplicates'] or
+                                      report['bad_days'] or report['gaps'] or report['zero_price'])
+
+    @staticmethod
+    def scan_all(file_name='stock_update.list', stock_types=('kd', 'k5'), processes=None):
+        # scans every file of a list in a process pool, returns the reports with problems
+        sbi = StocksBasicInfo()
+        if not sbi.load_from_file(file_name):
+            return []
+        calendar = StockIntegrity.calendar()
+        jobs = [(s.code, t) for s in sbi.get_list() for t in stock_types
+                if not (t == 'k5' and s.type == StockType.INDEX)]
+        with ProcessPoolExecutor(processes) as executor:
+            reports = list(executor.map(_integrity_scan, [j[0] for j in jobs], [j[1] for j in jobs],
+                                        [calendar] * len(jobs), chunksize=16))
+        reports = [r for r in reports if not StockIntegrity.is_clean(r)]
+        for r in reports:
+            print('{} {}: size error {}, unsorted {}, duplicates {}, zero price {}, bad days {}, gaps {}'.format(
+                r['code'], r['type'], r['size_error'], r['unsorted'], r['duplicates'], r['zero_price'],
+                len(r['bad_days']), len(r['gaps'])))
+        return reports
+
+    @staticmethod
+    def compact(code, stock_type, drop_partial=False, manifest=None):
+        # rewrites the file sorted by key, keeping the last written record of every key, optionally without
+        # incomplete k5 days; the index, derived bars and manifest entry are rebuilt. returns True if rewritten
+        data, size_error = StockIntegrity.read(code, stock_type)
+        if data is None:
+            return False
+        key = data[StockIntegrity.KEY[stock_type]]
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        keep = order[np.append(key[1:] != key[:-1], True)]
+        new_data = data[keep]
+        if drop_partial and stock_type == 'k5':
+            dates, inverse, counts = np.unique(new_data['time'] // 10000, return_inverse=True, return_counts=True)
+            new_data = new_data[counts[inverse] == 48]
+        if size_error == 0 and len(new_data) == len(data) and (keep == np.arange(len(data))).all():
+            return False
+        path = UtilsConfig.get_stock_data_path(code, stock_type=stock_type)
+        with open(path + '.tmp', 'wb') as f:
+            new_data.tofile(f)
+        os.replace(path + '.tmp', path)
+        if os.path.isfile(UtilsConfig.get_stock_data_path(code, stock_type=stock_type + '.idx')):
+            StockDataIndex(code, stock_type).build()
+        bar_types = StockBars.KD_TYPES if stock_type == 'kd' else StockBars.K5_TYPES
+        for bar_type in bar_types:
+            bar_path = UtilsConfig.get_stock_data_path(code, stock_type=bar_type)
+            if os.path.isfile(bar_path):
+                os.remove(bar_path)
+        StockBars(code).update(bar_types)
+        if manifest is not None:
+            manifest.update(code, stock_type)
+        return True
+
 
 class StockUpdateRecord:
-    def __init__(self, code_name):
+    def __init__(self, code_name, manifest=None):
         self.code_name = code_name
+        self.manifest = manifest
 
     def update_kd(self):
         path = UtilsConfig.get_stock_data_path(self.code_name, stock_type='kd')
+        rec = self.manifest.get(self.code_name, 'kd') if self.manifest is not None else None
         if path is not None:
-            if os.path.isfile(path) and os.path.getsize(path) > DataD.HEX_LEN:
+            if rec is not None:
+                date_str = str(rec[0])
+            elif os.path.isfile(path) and os.path.getsize(path) > DataD.HEX_LEN:
                 try:
                     file = open(path, 'rb')
                     file.seek(-DataD.HEX_LEN, 2)  # from the end of file
@@ -1068,27 +2299,30 @@ class StockUpdateRecord:
             date_now = datetime.datetime.now()
             date_record = datetime.datetime(int('20' + date_str[0:2]), int(date_str[2:4]), int(date_str[4:6]))
             if (date_now - date_record).days > 0:
-                file = open(path, 'ab')
+                offset = os.path.getsize(path) if os.path.isfile(path) else 0
                 kd_list = Stock.query_hist_kd(
                     self.code_name, start_date='20{}-{}-{}'.format(date_str[0:2], date_str[2:4], date_str[4:6]))
-                for item in kd_list:
-                    kd = DataD(*item)
-                    if int(date_str) < int(kd.date_str):
-                        file.write(pack(DataD.FMT_HEX,
-                                        # date, open, close, high, low, unused, volume, amount,
-                                        int(kd.date_str), kd.open, kd.close, kd.high, kd.low, 0, kd.volume, kd.amount,
-                                        # adjustflag, turn, tradestatus, pctChg, peTTM,
-                                        int(kd.adjust_flag), kd.turn, int(kd.trade_status), kd.pctChg, kd.peTTM,
-                                        # psTTM, pcfNcfTTM, pbMRQ, isST
-                                        kd.psTTM, kd.pcfNcfTTM, kd.pbMRQ, int(kd.isST)))
-                file.close()
+                data = DataD.from_rows(kd_list)
+                data = data[data['date'] > int(date_str)]
+                with open(path, 'ab') as file:
+                    file.write(data.tobytes())
+                StockDataIndex(self.code_name, 'kd').append(offset, data['date'])
+                StockBars(self.code_name).update(StockBars.KD_TYPES)
+                StockAdjust(self.code_name).update()
+                if self.manifest is not None:
+                    self.manifest.update(self.code_name, 'kd')
+            elif self.manifest is not None and rec is None:
+                self.manifest.update(self.code_name, 'kd')
         else:
             print('Get path failed.')
 
     def update_k5(self):
         path = UtilsConfig.get_stock_data_path(self.code_name, stock_type='k5')
+        rec = self.manifest.get(self.code_name, 'k5') if self.manifest is not None else None
         if path is not None:
-            if os.path.isfile(path) and os.path.getsize(path) > Data5.HEX_LEN:
+            if rec is not None:
+                date_str = str(rec[0] // 10000)
+            elif os.path.isfile(path) and os.path.getsize(path) > Data5.HEX_LEN:
                 try:
                     file = open(path, 'rb')
                     file.seek(-Data5.HEX_LEN, 2)  # from the end of file
@@ -1103,23 +2337,284 @@ class StockUpdateRecord:
             date_now = datetime.datetime.now()
             date_record = datetime.datetime(int('20' + date_str[0:2]), int(date_str[2:4]), int(date_str[4:6]))
             if (date_now - date_record).days > 0:
-                file = open(path, 'ab')
+                offset = os.path.getsize(path) if os.path.isfile(path) else 0
                 k5_list = Stock.query_hist_k5(
                     self.code_name, start_date='20{}-{}-{}'.format(date_str[0:2], date_str[2:4], date_str[4:6]))
-                if isinstance(k5_list, list):
-                    k5_list.sort(key=lambda i: int(i[0]))
-                k5_list.sort(key=lambda i: int(i[0]))
-                for item in k5_list:
-                    k5 = Data5(*item)
-                    if int(date_str) < int(k5.time_str[:6]):
-                        #  time, open, close, high, low, volume, amount
-                        file.write(pack(Data5.FMT_HEX, int(k5.time_str),
-                                        k5.open, k5.close, k5.high, k5.low, k5.volume, k5.amount))
-                file.close()
+                data = Data5.from_rows(k5_list)
+                data = data[data['time'] // 10000 > int(date_str)]
+                with open(path, 'ab') as file:
+                    file.write(data.tobytes())
+                StockDataIndex(self.code_name, 'k5').append(offset, data['time'] // 10000)
+                StockBars(self.code_name).update(StockBars.K5_TYPES)
+                if self.manifest is not None:
+                    self.manifest.update(self.code_name, 'k5')
+            elif self.manifest is not None and rec is None:
+                self.manifest.update(self.code_name, 'k5')
         else:
             print('Get path failed.')
 
 
+def _panel_load_stock(code, days, start_date, end_date, load_k5):
+    sd = StockData(code, mode=StockData.MODE_NP)
+    sd._load_np(days, days if load_k5 else 0, start_date, end_date)
+    return sd.kd_list, sd.k5_list
+
+
+class StocksPanel:
+    # all codes of a list aligned on one trading date axis:
+    #   kd: codes x dates x KD_FIELDS (float64, nan where not traded), kd_mask True where traded
+    #   k5: codes x dates x 48 (Data5.DTYPE, zero where not traded), k5_mask True where traded
+    KD_FIELDS = [name for name in DataD.DTYPE.names if name not in ('date', 'unused')]
+
+    def __init__(self, file_name='stock_update.list'):
+        self.file_name = file_name
+        self.codes = []
+        self.dates = np.zeros(0, dtype=np.uint32)
+        self.kd = np.zeros((0, 0, len(StocksPanel.KD_FIELDS)))
+        self.kd_mask = np.zeros((0, 0), dtype=bool)
+        self.k5 = np.zeros((0, 0, 48), dtype=Data5.DTYPE)
+        self.k5_mask = np.zeros((0, 0), dtype=bool)
+
+    def load(self, days, start_date=0, end_date=999999, load_k5=False, processes=None):
+        sbi = StocksBasicInfo()
+        if not sbi.load_from_file(self.file_name):
+            return False
+        codes = [s.code for s in sbi.get_list() if s.status is not StockStatus.DELISTING]
+        n = len(codes)
+        with ProcessPoolExecutor(processes) as executor:
+            items = list(executor.map(_panel_load_stock, codes, [days] * n, [start_date] * n, [end_date] * n,
+                                      [load_k5] * n, chunksize=16))
+        self.codes = codes
+        date_list = [kd['date'] for kd, _ in items if len(kd) > 0]
+        date_list += [k5[:, 0]['time'] // 10000 for _, k5 in items if load_k5 and len(k5) > 0]
+        self.dates = np.unique(np.concatenate(date_list)).astype(np.uint32) if len(date_list) > 0 else self.dates
+        self.kd = np.full((len(codes), len(self.dates), len(StocksPanel.KD_FIELDS)), np.nan)
+        self.kd_mask = np.zeros((len(codes), len(self.dates)), dtype=bool)
+        if load_k5:
+            self.k5 = np.zeros((len(codes), len(self.dates), 48), dtype=Data5.DTYPE)
+            self.k5_mask = np.zeros((len(codes), len(self.dates)), dtype=bool)
+        for i, (kd, k5) in enumerate(items):
+            if len(kd) > 0:
+                idx = np.searchsorted(self.dates, kd['date'])
+                for j, name in enumerate(StocksPanel.KD_FIELDS):
+                    self.kd[i, idx, j] = kd[name]
+                self.kd_mask[i, idx] = True
+            if load_k5 and len(k5) > 0:
+                idx = np.searchsorted(self.dates, k5[:, 0]['time'] // 10000)
+                self.k5[i, idx] = k5
+                self.k5_mask[i, idx] = True
+        return True
+
+    def kd_field(self, name):
+        # codes x dates view of one DataD field
+        return self.kd[:, :, StocksPanel.KD_FIELDS.index(name)]
+
+    def k5_field(self, name):
+        # codes x dates x 48 view of one Data5 field
+        return self.k5[name]
+
+    def code_index(self, code):
+        return self.codes.index(code)
+
+
+class StocksSnapshot:
+    # last WINDOW kd records of every code in one file of the list path, rebuilt after each kd update:
+    #   codes: code list, data: codes x WINDOW (DataD.DTYPE), right aligned, zero rows where missing
+    WINDOW = 20
+
+    def __init__(self, file_name='stock_snapshot.db', window=WINDOW):
+        self.file_name = file_name
+        self.path = UtilsConfig.get_stock_list_path(file_name)
+        self.window = window
+        self.codes = []
+        self.data = np.zeros((0, window), dtype=DataD.DTYPE)
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self.codes, self.data = pickle.load(f)
+            self.window = self.data.shape[1]
+        except:
+            return None
+        return self
+
+    def save(self):
+        if self.path is not None:
+            with open(self.path + '.tmp', 'wb') as f:
+                pickle.dump((self.codes, self.data), f)
+            os.replace(self.path + '.tmp', self.path)
+        return self
+
+    def build(self, code_list, manifest=None):
+        # rows whose last date still matches the manifest are reused from the previous snapshot
+        old = StocksSnapshot(self.file_name, self.window).load()
+        old_rows = {} if old is None or old.window != self.window else dict(zip(old.codes, old.data))
+        data = np.zeros((len(code_list), self.window), dtype=DataD.DTYPE)
+        for i, code in enumerate(code_list):
+            item = None if manifest is None else manifest.get(code, 'kd')
+            row = old_rows.get(code)
+            if item is not None and row is not None and row[-1]['date'] == item[0]:
+                data[i] = row
+                continue
+            path = UtilsConfig.get_stock_data_path(code, stock_type='kd')
+            if path is None or not os.path.isfile(path):
+                continue
+            kd = StockData.parse_np_kd(path, self.window)
+            if kd is not None and len(kd) > 0:
+                data[i, self.window - len(kd):] = kd
+        self.codes, self.data = list(code_list), data
+        return self.save()
+
+    def latest(self, name):
+        # one value per code from its last record
+        return self.data[:, -1][name]
+
+    def field(self, name):
+        # codes x WINDOW view of one DataD field
+        return self.data[name]
+
+    def valid(self):
+        return self.data['date'] > 0
+
+    def code_index(self, code):
+        return self.codes.index(code)
+
+
+def _screener_load_tail(code, window):
+    path = UtilsConfig.get_stock_data_path(code, stock_type='kd')
+    if path is None or not os.path.isfile(path):
+        return None
+    return StockData.parse_np_kd(path, window)
+
+
+class StocksScreener:
+    # evaluates filter expressions over the last `window` kd records of every code, e.g.
+    #   StocksScreener().load().screen('peTTM < 20 and turn > 3 and close > ma(close, 20) and hz300')
+    # names: DataD fields (codes x window), code, code_name, industry, ind_class, hz300, zz500, sz50 (codes x 1)
+    # functions: ma, ref, hhv, llv, std over the window axis; the last column of the result selects the codes
+    KD_FIELDS = [name for name in DataD.DTYPE.names if name not in ('unused',)]
+
+    def __init__(self, file_name='stock_all.list', window=StocksSnapshot.WINDOW):
+        self.file_name = file_name
+        self.window = window
+        self.codes = []
+        self.columns = {}
+
+    def load(self, processes=None):
+        # rows come from the snapshot when it covers the list, the kd files are read in parallel otherwise
+        sbi = StocksBasicInfo()
+        if not sbi.load_from_file(self.file_name):
+            return None
+        items = [s for s in sbi.get_list() if s.status is not StockStatus.DELISTING]
+        codes = [s.code for s in items]
+        data = np.zeros((len(codes), self.window), dtype=DataD.DTYPE)
+        snapshot = StocksSnapshot().load()
+        rows = {} if snapshot is None or snapshot.window < self.window else dict(zip(snapshot.codes, snapshot.data))
+        missing = [i for i, code in enumerate(codes) if code not in rows]
+        for i, code in enumerate(codes):
+            if code in rows:
+                data[i] = rows[code][-self.window:]
+        if len(missing) > 0:
+            if processes == 1:
+                tails = [_screener_load_tail(codes[i], self.window) for i in missing]
+            else:
+                with ProcessPoolExecutor(processes) as executor:
+                    tails = list(executor.map(_screener_load_tail, [codes[i] for i in missing],
+                                              [self.window] * len(missing), chunksize=16))
+            for i, kd in zip(missing, tails):
+                if kd is not None and len(kd) > 0:
+                    data[i, self.window - len(kd):] = kd
+        self.codes = codes
+        self.columns = {}
+        invalid = data['date'] == 0
+        for name in StocksScreener.KD_FIELDS:
+            self.columns[name] = np.where(invalid, np.nan, data[name].astype(np.float64))
+        self.columns['code'] = np.array(codes, dtype=str).reshape(-1, 1)
+        self.columns['code_name'] = np.array([s.code_name for s in items], dtype=str).reshape(-1, 1)
+        sii = StocksIndustryInfo()
+        industry = {x.code: x for x in sii.get_list()} if sii.load_from_file() else {}
+        self.columns['industry'] = np.array([industry[c].industry if c in industry else '-' for c in codes],
+                                            dtype=str).reshape(-1, 1)
+        self.columns['ind_class'] = np.array([industry[c].ind_class if c in industry else '-' for c in codes],
+                                             dtype=str).reshape(-1, 1)
+        for name, stocks_type in [('hz300', StocksSuperiorInfo.TYPE_HZ300), ('zz500', StocksSuperiorInfo.TYPE_ZZ500),
+                                  ('sz50', StocksSuperiorInfo.TYPE_SZ50)]:
+            ssi = StocksSuperiorInfo(stocks_type)
+            members = set(x.code for x in ssi.get_list()) if ssi.load_from_file() else set()
+            self.columns[name] = np.array([c in members for c in codes]).reshape(-1, 1)
+        return self
+
+    @staticmethod
+    def rolling(x, n, func):
+        x = np.asarray(x, dtype=np.float64)
+        res = np.full(x.shape, np.nan)
+        n = int(n)
+        if 0 < n <= x.shape[-1]:
+            res[..., n-1:] = func(np.lib.stride_tricks.sliding_window_view(x, n, axis=-1), axis=-1)
+        return res
+
+    @staticmethod
+    def ref(x, n=1):
+        x = np.asarray(x, dtype=np.float64)
+        res = np.full(x.shape, np.nan)
+        n = int(n)
+        if n < x.shape[-1]:
+            res[..., n:] = x[..., :x.shape[-1]-n]
+        return res
+
+    FUNCTIONS = {
+        'ma': lambda x, n: StocksScreener.rolling(x, n, np.mean),
+        'hhv': lambda x, n: StocksScreener.rolling(x, n, np.max),
+        'llv': lambda x, n: StocksScreener.rolling(x, n, np.min),
+        'std': lambda x, n: StocksScreener.rolling(x, n, np.std),
+        'ref': lambda x, n=1: StocksScreener.ref(x, n),
+        'abs': np.abs,
+    }
+
+    class _BoolTransformer(ast.NodeTransformer):
+        # and/or/not and chained comparisons -> element wise &, |, ~
+        def visit_BoolOp(self, node):
+            self.generic_visit(node)
+            op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+            res = node.values[0]
+            for value in node.values[1:]:
+                res = ast.BinOp(left=res, op=op, right=value)
+            return res
+
+        def visit_UnaryOp(self, node):
+            self.generic_visit(node)
+            if isinstance(node.op, ast.Not):
+                return ast.UnaryOp(op=ast.Invert(), operand=node.operand)
+            return node
+
+        def visit_Compare(self, node):
+            self.generic_visit(node)
+            if len(node.ops) == 1:
+                return node
+            left, res = node.left, None
+            for op, right in zip(node.ops, node.comparators):
+                cmp = ast.Compare(left=left, ops=[op], comparators=[right])
+                res = cmp if res is None else ast.BinOp(left=res, op=ast.BitAnd(), right=cmp)
+                left = right
+            return res
+
+    def evaluate(self, expr):
+        # codes x window (or codes x 1) result of an expression
+        tree = StocksScreener._BoolTransformer().visit(ast.parse(expr, mode='eval'))
+        code = compile(ast.fix_missing_locations(tree), '<screen>', 'eval')
+        names = dict(StocksScreener.FUNCTIONS)
+        names.update(self.columns)
+        with np.errstate(invalid='ignore'):
+            return eval(code, {'__builtins__': {}}, names)
+
+    def screen(self, expr):
+        # codes whose last record matches the expression
+        res = np.asarray(self.evaluate(expr))
+        res = np.broadcast_to(res, (len(self.codes), self.window) if res.ndim != 1 else (len(self.codes),))
+        mask = (res[:, -1] if res.ndim == 2 else res).astype(bool)
+        return [code for code, ok in zip(self.codes, mask) if ok]
+
+
 def get_hist_data_online(code, start_time, end_time, fqt=1):
     # fqt: 0,1,2: no,front,back
     # http://68.push2his.eastmoney.com/api/qt/stock/details/get?fields1=f1,f2,f3,f4&fields2=f51,f52,f53,f54,f55&secid=105.NDAQ&pos=-30
@@ -1144,101 +2639,344 @@ def get_hist_data_online(code, start_time, end_time, fqt=1):
 
 
 class EnvParam:
+    # sqlite table of pickled values, one row per param_name: get() only loads the rows it is asked for and
+    # save() only writes the params changed by put/delete/clear since the last save or load.
+    # every row also keeps the pickled size and the time it was last written or touched.
+    # a file written by the former whole-file pickle is migrated in place on first use
+    SQLITE_HEADER = b'SQLite format 3\x00'
+    TABLE = 'CREATE TABLE IF NOT EXISTS env (name TEXT PRIMARY KEY, value BLOB, size INTEGER, atime REAL)'
+
     def __init__(self, file_name='env.db'):
         self.env = {}
         self.file_name = file_name
+        self.dirty = set()
+        self.deleted = set()
+        self.cleared = False
+        self.checked = False
+        self.migrate()
         self.load()
 
-    def load(self):
+    def connect(self):
+        conn = sqlite3.connect(self.file_name, timeout=30)
+        if not self.checked:
+            conn.execute(EnvParam.TABLE)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(env)')]
+            for column, column_type in [('size', 'INTEGER'), ('atime', 'REAL')]:  # tables without the stats
+                if column not in columns:
+                    conn.execute('ALTER TABLE env ADD COLUMN {} {}'.format(column, column_type))
+            conn.commit()
+            self.checked = True
+        return conn
+
+    def migrate(self):
+        if not os.path.isfile(self.file_name) or os.path.getsize(self.file_name) == 0:
+            return
         try:
             with open(self.file_name, 'rb') as f:
-                self.env = pickle.load(f)
+                if f.read(len(EnvParam.SQLITE_HEADER)) == EnvParam.SQLITE_HEADER:
+                    return
+                f.seek(0)
+                env = pickle.load(f)
+            assert(isinstance(env, dict))
         except:
-            self.env = {}
+            # neither sqlite nor a complete pickle (the former save() wrote in place): start empty as before
+            print('Unreadable env file moved to {}.bad'.format(self.file_name))
+            os.replace(self.file_name, self.file_name + '.bad')
+            return
+        tmp_name = self.file_name + '.tmp'
+        if os.path.isfile(tmp_name):
+            os.remove(tmp_name)
+        now = time.time()
+        with closing(sqlite3.connect(tmp_name)) as conn:
+            conn.execute(EnvParam.TABLE)
+            rows = [(str(k), pickle.dumps(v, pickle.HIGHEST_PROTOCOL)) for k, v in env.items()]
+            conn.executemany('INSERT INTO env VALUES (?, ?, ?, ?)', [(k, v, len(v), now) for k, v in rows])
+            conn.commit()
+        os.replace(tmp_name, self.file_name)
+
+    def load(self):
+        # drops unsaved changes, params are read again on demand
+        self.env = {}
+        self.dirty, self.deleted, self.cleared = set(), set(), False
         return self
 
     def save(self):
-        with open(self.file_name, 'wb') as f:
-            pickle.dump(self.env, f)
+        if not (self.cleared or self.dirty or self.deleted):
+            return self
+        with closing(self.connect()) as conn:
+            with conn:
+                if self.cleared:
+                    conn.execute('DELETE FROM env')
+                conn.executemany('DELETE FROM env WHERE name = ?', [(k,) for k in self.deleted])
+                now = time.time()
+                rows = [(k, pickle.dumps(self.env[k], pickle.HIGHEST_PROTOCOL)) for k in self.dirty]
+                conn.executemany('INSERT OR REPLACE INTO env VALUES (?, ?, ?, ?)',
+                                 [(k, v, len(v), now) for k, v in rows])
+        self.dirty, self.deleted, self.cleared = set(), set(), False
         return self
 
     def get(self, param_name='default'):
-        return self.env[param_name] if param_name in self.env else None
+        param_name = str(param_name)
+        if param_name in self.env:
+            return self.env[param_name]
+        if self.cleared or param_name in self.deleted or not os.path.isfile(self.file_name):
+            return None
+        with closing(self.connect()) as conn:
+            row = conn.execute('SELECT value FROM env WHERE name = ?', (param_name,)).fetchone()
+        if row is None:
+            return None
+        self.env[param_name] = pickle.loads(row[0])
+        return self.env[param_name]
 
     def put(self, param, param_name='default'):
+        param_name = str(param_name)
         self.env[param_name] = param
+        self.dirty.add(param_name)
+        self.deleted.discard(param_name)
         return self
 
     def delete(self, param_name='default'):
-        if param_name in self.env:
-            del(self.env[param_name])
+        param_name = str(param_name)
+        self.env.pop(param_name, None)
+        self.dirty.discard(param_name)
+        self.deleted.add(param_name)
         return self
 
     def clear(self):
         self.env = {}
+        self.dirty, self.deleted, self.cleared = set(), set(), True
+        return self
+
+    def forget(self, param_name='default'):
+        # drops a saved param from memory only, the next get() reads it again
+        param_name = str(param_name)
+        if param_name not in self.dirty:
+            self.env.pop(param_name, None)
+        return self
+
+    def touch(self, access):
+        # access: {param_name: time}, updates the access time of saved params
+        if len(access) > 0 and os.path.isfile(self.file_name):
+            with closing(self.connect()) as conn:
+                with conn:
+                    conn.executemany('UPDATE env SET atime = ? WHERE name = ?',
+                                     [(t, str(k)) for k, t in access.items()])
+        return self
+
+    def stats(self, param_names=None):
+        # {param_name: (pickled size, last access time)} of the saved params, all of them by default
+        if not os.path.isfile(self.file_name):
+            return {}
+        query = 'SELECT name, COALESCE(size, LENGTH(value)), COALESCE(atime, 0) FROM env'
+        with closing(self.connect()) as conn:
+            if param_names is None:
+                rows = conn.execute(query).fetchall()
+            else:
+                rows = [row for k in param_names for row in conn.execute(query + ' WHERE name = ?', (str(k),))]
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def keys(self):
+        names = set()
+        if not self.cleared and os.path.isfile(self.file_name):
+            with closing(self.connect()) as conn:
+                names = set(row[0] for row in conn.execute('SELECT name FROM env'))
+        return (names - self.deleted) | self.dirty
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class HistCache:
+    # in-process LRU bounded by MEM_BUDGET bytes over an EnvParam disk tier bounded by DISK_BUDGET bytes.
+    # sizes are the pickled sizes, the disk tier evicts by the size and access time kept in every EnvParam row,
+    # so series written by other processes or before the stats existed are counted too
+    MEM_BUDGET = 64 * 1024 * 1024
+    DISK_BUDGET = 256 * 1024 * 1024
+    TOUCH_INTERVAL = 60  # seconds, access times of memory hits are written in batches
+    instances = {}
+
+    def __init__(self, env_name='.cache', mem_budget=MEM_BUDGET, disk_budget=DISK_BUDGET):
+        self.env = EnvParam(env_name)
+        self.mem_budget = mem_budget
+        self.disk_budget = disk_budget
+        self.lru = OrderedDict()  # name -> (value, size)
+        self.mem_size = 0
+        self.access = {}  # name -> last access time of memory hits not written yet
+        self.touched = time.time()
+
+    @staticmethod
+    def shared(env_name='.cache'):
+        # one instance per cache file for get_hist_data and CHistCache
+        if env_name not in HistCache.instances:
+            HistCache.instances[env_name] = HistCache(env_name)
+        return HistCache.instances[env_name]
+
+    def _mem_put(self, name, value, size):
+        if name in self.lru:
+            self.mem_size -= self.lru.pop(name)[1]
+        self.lru[name] = (value, size)
+        self.mem_size += size
+        while self.mem_size > self.mem_budget and len(self.lru) > 1:
+            self.mem_size -= self.lru.popitem(last=False)[1][1]
+
+    def _touch(self):
+        self.env.touch(self.access)
+        self.access = {}
+        self.touched = time.time()
+
+    def get(self, name):
+        if name in self.lru:
+            self.lru.move_to_end(name)
+            self.access[name] = time.time()
+            if time.time() - self.touched >= HistCache.TOUCH_INTERVAL:
+                self._touch()
+            return self.lru[name][0]
+        value = self.env.get(name)
+        if value is None:
+            return None
+        self.env.forget(name)  # kept by the LRU only
+        self.access[name] = time.time()
+        self._touch()
+        size = self.env.stats([name]).get(name, (0, 0))[0]
+        self._mem_put(name, value, size)
+        return value
+
+    def put(self, value, name):
+        self.env.put(value, name).save()
+        self.env.forget(name)
+        self.access.pop(name, None)
+        self._touch()
+        stats = self.env.stats()
+        self._mem_put(name, value, stats.get(name, (0, 0))[0])
+        disk_size = sum(v[0] for v in stats.values())
+        for old_name in sorted(stats, key=lambda k: stats[k][1]):
+            if disk_size <= self.disk_budget:
+                break
+            if old_name != name:
+                disk_size -= stats[old_name][0]
+                self.env.delete(old_name)
+        self.env.save()
+        return self
+
+    def delete(self, name):
+        if name in self.lru:
+            self.mem_size -= self.lru.pop(name)[1]
+        self.access.pop(name, None)
+        self.env.delete(name).save()
+        return self
+
+    def clear(self):
+        self.lru.clear()
+        self.mem_size = 0
+        self.access = {}
+        self.env.clear().save()
         return self
 
 
+class HistEntry:
+    # cached series of get_hist_data: the DataD list with its sorted date_num array and price columns,
+    # windows are found with searchsorted and the column windows are views
+    COLUMNS = ['open', 'close', 'high', 'low', 'volume', 'amount']
+
+    def __init__(self, data):
+        self.data = list(data)
+        self.dates = np.array([x.date_num for x in self.data], dtype=np.uint32)
+        self.columns = {name: np.array([getattr(x, name) for x in self.data], dtype=np.float64)
+                        for name in HistEntry.COLUMNS}
+
+    def __len__(self):
+        return len(self.data)
+
+    @staticmethod
+    def wrap(value):
+        # series cached before the entries were introduced are plain DataD lists
+        return HistEntry(value) if isinstance(value, list) else value
+
+    def index(self, start_time, end_time):
+        return int(np.searchsorted(self.dates, int(start_time), 'left')), \
+               int(np.searchsorted(self.dates, int(end_time), 'right'))
+
+    def window(self, start_time, end_time):
+        s_idx, e_idx = self.index(start_time, end_time)
+        return self.data[s_idx:e_idx]
+
+    def columns_window(self, start_time, end_time):
+        s_idx, e_idx = self.index(start_time, end_time)
+        columns = {name: value[s_idx:e_idx] for name, value in self.columns.items()}
+        columns['date'] = self.dates[s_idx:e_idx]
+        return columns
+
+
+def _hist_data_merge(hist_data, head, tail):
+    # head/tail are fetched including the first/last cached day, a different close there means the
+    # adjusted prices were rebased by a new dividend and the cached series is stale (returns None)
+    for data, item in [(head, hist_data[0]), (tail, hist_data[-1])]:
+        same = [x for x in data if x.date_num == item.date_num]
+        if len(same) > 0 and abs(same[0].close - item.close) > 1e-6:
+            return None
+    head = [x for x in head if x.date_num < hist_data[0].date_num]
+    tail = [x for x in tail if x.date_num > hist_data[-1].date_num]
+    return head + hist_data + tail
+
+
 def get_hist_data(code, start_time, end_time, fqt=1, force_update=False):
-    env_name = '.cache'
-    env = EnvParam(env_name)
+    cache = HistCache.shared()
     hist_name = str(code) + str(fqt)
-    hist_data = env.get(hist_name)
+    entry = HistEntry.wrap(cache.get(hist_name))
+    hist_data = None if entry is None else entry.data
     update_hist_flag = force_update
     min_start = 999999
     max_end = 0
     if hist_data is None or len(hist_data) < 2:
         update_hist_flag = True
-        if len(env.env) > 32:
-            env.clear().save()
-    elif hist_data[0].date_num > int(start_time) or hist_data[-1].date_num < int(end_time):
-        update_hist_flag = True
-        min_start = hist_data[0].date_num
-        max_end = hist_data[-1].date_num
-        env.delete(hist_name).save()
+    elif not force_update and (hist_data[0].date_num > int(start_time) or hist_data[-1].date_num < int(end_time)):
+        # only the missing head and tail are downloaded
+        head, tail = [], []
+        if hist_data[0].date_num > int(start_time):
+            head = get_hist_data_online(code, Date.get_day(int(start_time), -10), hist_data[0].date_num, fqt) or []
+        if hist_data[-1].date_num < int(end_time):
+            tail = get_hist_data_online(code, hist_data[-1].date_num, int(end_time), fqt) or []
+        merged = _hist_data_merge(hist_data, head, tail)
+        if merged is None:
+            update_hist_flag = True
+            min_start = hist_data[0].date_num
+            max_end = hist_data[-1].date_num
+        elif len(merged) > len(hist_data):
+            hist_data = merged
+            entry = HistEntry(hist_data)
+            cache.put(entry, hist_name)
+            print('Update hist data: {} {}-{} (get {} items {}-{})'.format(
+                code, start_time, end_time, len(head) + len(tail), hist_data[0].date_num, hist_data[-1].date_num))
     if update_hist_flag:
         hist_data = get_hist_data_online(code, Date.get_day(min(min_start, int(start_time)), -10),
-                                         max(max_end, int(end_time)), fqt)
-        env.put(hist_data, hist_name).save()
+                                         max(max_end, int(end_time)), fqt) or []
+        entry = HistEntry(hist_data)
+        cache.put(entry, hist_name)
         if len(hist_data) > 0:
             print('Update hist data: {} {}-{} (get {} items {}-{})'.format(
                 code, start_time, end_time, len(hist_data), hist_data[0].date_num, hist_data[-1].date_num))
         else:
             print('Update hist data: {} {}-{} (No data found)')
-    s_idx = 0
-    e_idx = len(hist_data)
-    for i in range(len(hist_data)):
-        if hist_data[i].date_num >= int(start_time):
-            s_idx = i
-            break
-    for i in range(len(hist_data)-1, -1, -1):
-        if hist_data[i].date_num <= int(end_time):
-            e_idx = i + 1
-            break
-    return hist_data[s_idx:e_idx]
+    return entry.window(start_time, end_time)
 
 
 class CHistCache:
     def __init__(self, env_name='.cache'):
+        self.cache = HistCache.shared(env_name)
 
-        self.env = EnvParam(env_name)
+    def get_entry(self, code, fqt=1):
+        hist_name = str(code) + str(fqt)
+        entry = HistEntry.wrap(self.cache.get(hist_name))
+        return None if entry is None or len(entry) < 2 else entry
 
     def get(self, code, start_time, end_time, fqt=1):
-        hist_name = str(code) + str(fqt)
-        hist_data = self.env.get(hist_name)
-        if hist_data is None or len(hist_data) < 2:
-            return []
-        s_idx = 0
-        e_idx = len(hist_data)
-        for i in range(len(hist_data)):
-            if hist_data[i].date_num >= int(start_time):
-                s_idx = i
-                break
-        for i in range(len(hist_data)-1, -1, -1):
-            if hist_data[i].date_num <= int(end_time):
-                e_idx = i + 1
-                break
-        return hist_data[s_idx:e_idx]
+        entry = self.get_entry(code, fqt)
+        return [] if entry is None else entry.window(start_time, end_time)
+
+    def get_columns(self, code, start_time, end_time, fqt=1):
+        # date and HistEntry.COLUMNS arrays of the window, views of the cached entry
+        entry = self.get_entry(code, fqt)
+        return None if entry is None else entry.columns_window(start_time, end_time)
 
 
 class Date: